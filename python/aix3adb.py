@@ -4,22 +4,173 @@ import subprocess
 import cookielib
 import urlparse
 import os
+import sys
 import datetime
 import getpass
+import sqlite3
+import json
+import time
+import optparse
+import threading
+import contextlib
+import socket
+import errno
+import httplib
+import fcntl
+import atexit
+from multiprocessing.pool import ThreadPool
 
 from datetime import datetime
 log = logging.getLogger( 'aix3adb' )
 
 def tryServerAuth(funct):
     def func_wrapper(instance, *args, **kwargs):
+        # remember the cookie this call used, so a cookie renewed by
+        # another process in the meantime is not renewed again
+        cookiestamp = instance.credentialManager().cookieStamp()
         try:
             return funct(instance, *args, **kwargs)
         except xmlrpclib.ProtocolError:
-            instance.destroyauth()
-            instance.authorize()
+            instance.reauthorize(cookiestamp)
             return funct(instance, *args, **kwargs)
     return func_wrapper
 
+def kerberosExpiry():
+    """Returns the expiry time of the CERN kerberos ticket in seconds since the epoch, None if there is none."""
+    p = subprocess.Popen( [ 'klist' ], stderr=subprocess.STDOUT, stdout=subprocess.PIPE ,shell=True)
+    stdout, stderr = p.communicate()
+    for line in stdout.split('\n'):
+        if "CERN.CH@CERN.CH" in line:
+            splitline = line.split()
+            try:
+                expireTime = datetime.strptime( splitline[2] + " " + splitline[3] , "%m/%d/%y %H:%M:%S" )
+            except (IndexError, ValueError):
+                continue
+            return time.mktime( expireTime.timetuple() )
+    return None
+
+def hasTerminal():
+    """Returns True if a user can be asked for input on stdin."""
+    return sys.stdin is not None and sys.stdin.isatty()
+
+class CredentialManager:
+    """Shares one SSO cookie file between threads and processes.
+
+    All renewals of the cookie happen under an exclusive lock on
+    lockfile. A renewal is skipped if the cookie changed since the
+    caller last used it, because another process renewed it already.
+    The new cookie is written to a temporary file and moved into place,
+    so readers never see a partial file. The cookie is renewed
+    refreshbefore seconds before it expires. Session cookies, which have
+    no expiry, are assumed to live cookielifetime seconds. A background
+    thread started with startRefresh() renews the cookie and the
+    kerberos ticket before they expire.
+    """
+    def __init__(self, cookiefile, authurl, domain, refreshbefore=1800, cookielifetime=8 * 3600, lockfile=None):
+        self.cookiefile = cookiefile
+        self.authurl = authurl
+        self.domain = domain
+        self.refreshbefore = refreshbefore
+        self.cookielifetime = cookielifetime
+        self.lockfile = lockfile if lockfile is not None else cookiefile + '.lock'
+        self._threadLock = threading.Lock()
+        self._refreshThread = None
+        self._stopRefresh = threading.Event()
+
+    @contextlib.contextmanager
+    def lock(self):
+        # flock only excludes other processes, the thread lock other threads
+        with self._threadLock:
+            with open(self.lockfile, 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def cookieStamp(self):
+        """Identifies the current cookie file, None if there is none."""
+        try:
+            stat = os.stat(self.cookiefile)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def cookieExpiry(self):
+        """Returns the expiry of the cookie in seconds since the epoch, None if there is no cookie."""
+        try:
+            mtime = os.path.getmtime(self.cookiefile)
+            jar = cookielib.MozillaCookieJar(self.cookiefile)
+            jar.load(ignore_discard=True, ignore_expires=True)
+        except (OSError, IOError, cookielib.LoadError):
+            return None
+        expiries = [cookie.expires for cookie in jar if cookie.domain == self.domain]
+        if not expiries:
+            return None
+        expiries = [expiry if expiry else mtime + self.cookielifetime for expiry in expiries]
+        return min(expiries)
+
+    def needsRefresh(self):
+        expiry = self.cookieExpiry()
+        return expiry is None or expiry - time.time() < self.refreshbefore
+
+    def obtainCookie(self):
+        tmpfile = "%s.%d.tmp" % (self.cookiefile, os.getpid())
+        call = ['env', '-i', 'cern-get-sso-cookie', '--krb', '--url', self.authurl, '--reprocess', '--outfile', tmpfile]
+        x = subprocess.call(call)
+        if x > 0 or not os.path.exists(tmpfile):
+            log.error("Failed to retrieve a cookie, authentication not possible")
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return False
+        os.rename(tmpfile, self.cookiefile)
+        return True
+
+    def refresh(self, force=False, cookiestamp=None):
+        """Renews the cookie if necessary.
+
+        With force the cookie is renewed even if it is not about to
+        expire, unless it changed since cookiestamp. Returns True if the
+        cookie file changed since cookiestamp or was renewed now.
+        """
+        with self.lock():
+            if cookiestamp is not None and self.cookieStamp() != cookiestamp:
+                renewed = True
+            elif force or self.needsRefresh():
+                renewed = self.obtainCookie()
+            else:
+                renewed = False
+        return renewed
+
+    def renewTicket(self):
+        """Renews a renewable kerberos ticket which is about to expire."""
+        expiry = kerberosExpiry()
+        if expiry is None or expiry - time.time() > self.refreshbefore:
+            return
+        if subprocess.call(['kinit', '-R']) != 0:
+            log.warning("Kerberos ticket expires soon and could not be renewed, please call kinit")
+
+    def startRefresh(self, interval=300):
+        """Starts a daemon thread which renews the cookie and ticket every interval seconds if needed."""
+        if self._refreshThread is not None and self._refreshThread.is_alive():
+            return
+        self._stopRefresh.clear()
+        def refreshLoop():
+            while not self._stopRefresh.wait(interval):
+                try:
+                    self.renewTicket()
+                    self.refresh()
+                except Exception, e:
+                    log.error("Background credential refresh failed: " + str(e))
+        self._refreshThread = threading.Thread(target=refreshLoop)
+        self._refreshThread.daemon = True
+        self._refreshThread.start()
+        # end the loop before the interpreter tears down the modules it uses
+        atexit.register(self.stopRefresh)
+
+    def stopRefresh(self):
+        self._stopRefresh.set()
+
 class Aix3adbException(Exception):
     pass
 
@@ -44,32 +195,137 @@ class MCSkim(Aix3adbBaseElement):
 class DataSkim(Aix3adbBaseElement):
     pass
 
+class ServerProxyPool:
+    """A thread-safe pool of ServerProxy objects.
+
+    Each proxy keeps its own keep-alive connection, so a proxy is only
+    used by one thread at a time. Proxies are created on demand by
+    factory, up to size proxies are in use at the same time. reset()
+    discards all proxies, e.g. after new cookies were obtained.
+    """
+    def __init__(self, factory, size=4):
+        self.factory = factory
+        self.size = size
+        self.generation = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def borrow(self):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                if self._idle:
+                    generation, proxy = self._idle.pop()
+                else:
+                    generation, proxy = self.generation, None
+            if proxy is None:
+                proxy = self.factory()
+            reusable = False
+            try:
+                yield proxy
+                reusable = True
+            except (Aix3adbException, xmlrpclib.Fault):
+                # the server answered, the connection is still fine
+                reusable = True
+                raise
+            finally:
+                with self._lock:
+                    if reusable and generation == self.generation:
+                        self._idle.append((generation, proxy))
+                        proxy = None
+                if proxy is not None:
+                    closeServerProxy(proxy)
+        finally:
+            self._slots.release()
+
+    def reset(self):
+        with self._lock:
+            self.generation += 1
+            idle, self._idle = self._idle, []
+        for generation, proxy in idle:
+            closeServerProxy(proxy)
+
+def closeServerProxy(proxy):
+    try:
+        proxy("close")()
+    except Exception:
+        pass
+
+_credentialManagers = {}
+_credentialManagersLock = threading.Lock()
+
 class aix3adb:
-    def __init__(self, cookiefilepath='aix3adb-ssocookie.txt', passphrase = None):
+    def __init__(self, cookiefilepath='aix3adb-ssocookie.txt', passphrase = None, poolsize = 4, autorefresh = True):
         self.cookiefile = os.path.abspath(cookiefilepath)
         self.authurl = 'https://cms-project-aachen3a-datasets.web.cern.ch/cms-project-aachen3a-datasets/aix3adb2/xmlrpc_auth/x3adb_write.php'
         self.readurl = 'https://cms-project-aachen3a-datasets.web.cern.ch/cms-project-aachen3a-datasets/aix3adb2/xmlrpc/x3adb_read.php'
         self.domain  = 'cms-project-aachen3a-datasets.web.cern.ch'
         self.passphrase = passphrase
+        self.poolsize = poolsize
+        # renew cookie and kerberos ticket in the background once they are used
+        self.autorefresh = autorefresh
+        self._readPool = None
+        self._authPool = None
+        self._poolLock = threading.Lock()
+
+    # connection pools can not be pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_readPool', '_authPool', '_poolLock'):
+            state.pop(key, None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.poolsize = state.get('poolsize', 4)
+        self._readPool = None
+        self._authPool = None
+        self._poolLock = threading.Lock()
+
+    def getReadServerProxy(self):
+        return xmlrpclib.ServerProxy(self.readurl, transport(self.readurl, cookies=False))
+    # borrow a ServerProxy for the read url from the pool
+    def readProxy(self):
+        with self._poolLock:
+            if self._readPool is None:
+                self._readPool = ServerProxyPool(self.getReadServerProxy, self.poolsize)
+        return self._readPool.borrow()
+    # borrow an authenticated ServerProxy from the pool
+    def authProxy(self):
+        # proxies with an outdated cookie are discarded
+        cookiestamp = self.credentialManager().cookieStamp()
+        with self._poolLock:
+            if self._authPool is None:
+                self._authPool = ServerProxyPool(self.getAuthServerProxy, self.poolsize)
+            elif cookiestamp != getattr(self, '_authCookieStamp', None):
+                self._authPool.reset()
+            self._authCookieStamp = cookiestamp
+        return self._authPool.borrow()
+    # discard authenticated proxies, their cookies are outdated
+    def resetAuthProxies(self):
+        with self._poolLock:
+            if self._authPool is not None:
+                self._authPool.reset()
 
     def checkKinit( self ):
-        call = [ 'klist' ]
-        p = subprocess.Popen( call, stderr=subprocess.STDOUT, stdout=subprocess.PIPE ,shell=True)
-        stdout, stderr = p.communicate()
-        now = datetime.today()
-        for line in stdout.split('\n'):
-            if "CERN.CH@CERN.CH" in line:
-                splitline = line.split()
-                expireTime = datetime.strptime( splitline[2] + " " + splitline[3] , "%m/%d/%y %H:%M:%S" )
-                timeLeft = expireTime - now
-                hours = timeLeft.seconds / 3600
-                minutes = ( timeLeft.seconds % 3600 ) / 60
-                seconds = ( timeLeft.seconds % 60 )
-                print "kerberos expire time: ", expireTime
-                print "left ", hours, "h ", minutes, "m " , seconds, 's'
-                self.passphrase = getpass.getpass('Press return to proceed or enter your CERN pass phrase for kinit:')
-                if len( self.passphrase ) < 1:
-                    return True
+        expiry = kerberosExpiry()
+        if not hasTerminal():
+            # nobody can answer a prompt, use a valid ticket or fail
+            if expiry is not None and expiry > time.time():
+                return True
+            raise Aix3adbException("No valid kerberos ticket and no terminal to ask for the pass phrase, call kinit first")
+        if expiry is not None:
+            expireTime = datetime.fromtimestamp( expiry )
+            timeLeft = expireTime - datetime.today()
+            hours = timeLeft.seconds / 3600
+            minutes = ( timeLeft.seconds % 3600 ) / 60
+            seconds = ( timeLeft.seconds % 60 )
+            print "kerberos expire time: ", expireTime
+            print "left ", hours, "h ", minutes, "m " , seconds, 's'
+            self.passphrase = getpass.getpass('Press return to proceed or enter your CERN pass phrase for kinit:')
+            if len( self.passphrase ) < 1:
+                return True
         return False
 
     def callKinit( self, username = None , trykerberos=3):
@@ -77,6 +333,8 @@ class aix3adb:
         call = ['kinit']
         if username is not None:
             call.append(username + "@CERN.CH")
+        if not self.passphrase and not hasTerminal():
+            raise Aix3adbException("kinit needs a pass phrase but there is no terminal, call kinit first or pass the pass phrase")
         for i in range(trykerberos):
             if not self.passphrase:
                 x = subprocess.call(call)
@@ -92,13 +350,34 @@ class aix3adb:
         if not self.checkKinit:
             self.callKinit( username = username, trykerberos = trykerberos)
         self.obtainSSOCookies()
+        self.resetAuthProxies()
 
     def obtainSSOCookies(self):
-        call = ['env', '-i', 'cern-get-sso-cookie', '--krb', '--url', self.authurl, '--reprocess', '--outfile', self.cookiefile]
-        x = subprocess.call(call)
-        if x > 0:
-            log.error("Failed to retrieve a cookie, authentication not possible")
+        self.credentialManager().refresh(force=True)
+
+    # the credential manager shared by all aix3adb objects using the same cookie file,
+    # it starts the background refresh when it is created unless autorefresh is False
+    def credentialManager(self):
+        key = (self.cookiefile, self.authurl, self.domain)
+        with _credentialManagersLock:
+            if key not in _credentialManagers:
+                _credentialManagers[key] = CredentialManager(self.cookiefile, self.authurl, self.domain)
+                if getattr(self, 'autorefresh', True):
+                    _credentialManagers[key].startRefresh()
+            return _credentialManagers[key]
+
+    # called when the server rejected the cookie identified by cookiestamp
+    def reauthorize(self, cookiestamp=None):
+        self.resetAuthProxies()
+        self.credentialManager().refresh(force=True, cookiestamp=cookiestamp)
+
+    # renew cookie and kerberos ticket in the background before they expire
+    def startCredentialRefresh(self, interval=300):
+        manager = self.credentialManager()
+        manager.refresh()
+        manager.startRefresh(interval)
     def destroyauth(self):
+        self.resetAuthProxies()
         try:
             os.remove(self.cookiefile)
         except:
@@ -109,102 +388,102 @@ class aix3adb:
         s = xmlrpclib.ServerProxy(self.authurl, customtransport)
         return s
     def getMCMaxSkimID(self):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getMCMaxSkimID( )
-        return MCSkim(result['skim']).id
+        with self.readProxy() as s:
+            result = s.getMCMaxSkimID( )
+            return MCSkim(result['skim']).id
     def getDataMaxSkimID(self):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getDataMaxSkimID( )
-        return DataSkim(result['skim']).id
+        with self.readProxy() as s:
+            result = s.getDataMaxSkimID( )
+            return DataSkim(result['skim']).id
     # inserts
     @tryServerAuth
     def insertMCSample(self, sample):
-        s = self.getAuthServerProxy()
-        f = s.insertMCSample(sample.__dict__)
-        return MCSample(f)
+        with self.authProxy() as s:
+            f = s.insertMCSample(sample.__dict__)
+            return MCSample(f)
     @tryServerAuth
     def insertDataSample(self, sample):
-        s = self.getAuthServerProxy()
-        return DataSample(s.insertDataSample(sample.__dict__))
+        with self.authProxy() as s:
+            return DataSample(s.insertDataSample(sample.__dict__))
     @tryServerAuth
     def insertMCSkim(self, skim):
-        s = self.getAuthServerProxy()
-        return MCSkim(s.insertMCSkim(skim.__dict__))
+        with self.authProxy() as s:
+            return MCSkim(s.insertMCSkim(skim.__dict__))
     @tryServerAuth
     def insertDataSkim(self, skim):
-        s = self.getAuthServerProxy()
-        return DataSkim(s.insertDataSkim(skim.__dict__))
+        with self.authProxy() as s:
+            return DataSkim(s.insertDataSkim(skim.__dict__))
     # edits
     @tryServerAuth
     def editMCSample(self, sample):
-        s = self.getAuthServerProxy()
-        return MCSample(s.editMCSample(sample))
+        with self.authProxy() as s:
+            return MCSample(s.editMCSample(sample))
     @tryServerAuth
     def editDataSample(self, sample):
-        s = self.getAuthServerProxy()
-        return DataSample(s.editDataSample(sample))
+        with self.authProxy() as s:
+            return DataSample(s.editDataSample(sample))
     @tryServerAuth
     def editMCSkim(self, skim):
-        s = self.getAuthServerProxy()
-        return MCSkim(s.editMCSkim(skim))
+        with self.authProxy() as s:
+            return MCSkim(s.editMCSkim(skim))
     @tryServerAuth
     def editDataSkim(self, skim):
-        s = self.getAuthServerProxy()
-        return DataSkim(s.editDataSkim(skim))
+        with self.authProxy() as s:
+            return DataSkim(s.editDataSkim(skim))
     # deletes
     @tryServerAuth
     def deleteMCSampleByName(self, name):
-        s = self.getAuthServerProxy()
-        return s.deleteMCSample(name)["info"]
+        with self.authProxy() as s:
+            return s.deleteMCSample(name)["info"]
     @tryServerAuth
     def deleteDataSampleByName(self, name):
-        s = self.getAuthServerProxy()
-        return s.deleteDataSample(name)["info"]
+        with self.authProxy() as s:
+            return s.deleteDataSample(name)["info"]
     @tryServerAuth
     def deleteMCSkimById(self, skimid):
-        s = self.getAuthServerProxy()
-        return s.deleteMCSkim(skimid)["info"]
+        with self.authProxy() as s:
+            return s.deleteMCSkim(skimid)["info"]
     @tryServerAuth
     def deleteDataSkimById(self, skimid):
-        s = self.getAuthServerProxy()
-        return s.editDataSkim(skimid)["info"]
+        with self.authProxy() as s:
+            return s.editDataSkim(skimid)["info"]
     # gets
     def getMCSample(self, name):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        return MCSample(s.getMCSample(name))
+        with self.readProxy() as s:
+            return MCSample(s.getMCSample(name))
     def getDataSample(self, name):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        return DataSample(s.getDataSample(name))
+        with self.readProxy() as s:
+            return DataSample(s.getDataSample(name))
     def getMCSkim(self, skimid):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        return MCSkim(s.getMCSkim(skimid))
+        with self.readProxy() as s:
+            return MCSkim(s.getMCSkim(skimid))
     def getDataSkim(self, skimid):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        return DataSkim(s.getDataSkim(skimid))
+        with self.readProxy() as s:
+            return DataSkim(s.getDataSkim(skimid))
     def getMCLatestSkimAndSampleBySample(self, name, isfinished=True):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getMCLatestSkimAndSampleBySample( name, isfinished  )
-        return MCSkim(result['skim']), MCSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getMCLatestSkimAndSampleBySample( name, isfinished  )
+            return MCSkim(result['skim']), MCSample(result['sample'])
     def getDataLatestSkimAndSampleBySample(self, name, isfinished=True):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getDataLatestSkimAndSampleBySample(name, isfinished)
-        return DataSkim(result['skim']), DataSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getDataLatestSkimAndSampleBySample(name, isfinished)
+            return DataSkim(result['skim']), DataSample(result['sample'])
     def getMCLatestSkimAndSampleByDatasetpath(self, datasetpath, isfinished=True):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getMCLatestSkimAndSampleByDatasetpath( datasetpath , isfinished )
-        return MCSkim(result['skim']), MCSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getMCLatestSkimAndSampleByDatasetpath( datasetpath , isfinished )
+            return MCSkim(result['skim']), MCSample(result['sample'])
     def getDataLatestSkimAndSampleByDatasetpath(self, datasetpath, isfinished=True):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getDataLatestSkimAndSampleByDatasetpath( datasetpath, isfinished )
-        return DataSkim(result['skim']), DataSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getDataLatestSkimAndSampleByDatasetpath( datasetpath, isfinished )
+            return DataSkim(result['skim']), DataSample(result['sample'])
     def getMCSkimAndSampleBySkim(self, skimid):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getMCSkimAndSampleBySkim(skimid)
-        return MCSkim(result['skim']), MCSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getMCSkimAndSampleBySkim(skimid)
+            return MCSkim(result['skim']), MCSample(result['sample'])
     def getDataSkimAndSampleBySkim(self, skimid):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.getDataSkimAndSampleBySkim(skimid)
-        return DataSkim(result['skim']), DataSample(result['sample'])
+        with self.readProxy() as s:
+            result = s.getDataSkimAndSampleBySkim(skimid)
+            return DataSkim(result['skim']), DataSample(result['sample'])
     def getMCSkimAndSample(self, skimid=None, name=None):
         if skimid is not None:
             skim, sample = self.getMCSkimAndSampleBySkim(skimid)
@@ -218,17 +497,254 @@ class aix3adb:
         return skim, sample
     #search
     def searchMCSkimsAndSamples(self, skimCriteria, sampleCriteria, start=0, limit=20):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.searchMCSkimsAndSamples(skimCriteria, sampleCriteria, start, limit)
-        if "error" in result:
-            raise Aix3adbException(result["error"])
-        return [(MCSkim(x['skim']), MCSample(x['sample'])) for x in result]
+        with self.readProxy() as s:
+            result = s.searchMCSkimsAndSamples(skimCriteria, sampleCriteria, start, limit)
+            if "error" in result:
+                raise Aix3adbException(result["error"])
+            return [(MCSkim(x['skim']), MCSample(x['sample'])) for x in result]
     def searchDataSkimsAndSamples(self, skimCriteria, sampleCriteria, start=0, limit=20):
-        s = xmlrpclib.ServerProxy(self.readurl)
-        result = s.searchDataSkimsAndSamples(skimCriteria, sampleCriteria, start, limit)
-        if "error" in result:
-            raise Aix3adbException(result["error"])
-        return [(DataSkim(x['skim']), DataSample(x['sample'])) for x in result]
+        with self.readProxy() as s:
+            result = s.searchDataSkimsAndSamples(skimCriteria, sampleCriteria, start, limit)
+            if "error" in result:
+                raise Aix3adbException(result["error"])
+            return [(DataSkim(x['skim']), DataSample(x['sample'])) for x in result]
+    # paginated search
+    def iterMCSkimsAndSamples(self, skimCriteria, sampleCriteria, pagesize=100):
+        """Generator over all (skim, sample) pairs matching the criteria.
+
+        The results are requested in pages of pagesize entries.
+        """
+        return self._iterSearch(self.searchMCSkimsAndSamples, skimCriteria, sampleCriteria, pagesize)
+    def iterDataSkimsAndSamples(self, skimCriteria, sampleCriteria, pagesize=100):
+        """Generator over all (skim, sample) pairs matching the criteria.
+
+        The results are requested in pages of pagesize entries.
+        """
+        return self._iterSearch(self.searchDataSkimsAndSamples, skimCriteria, sampleCriteria, pagesize)
+    def _iterSearch(self, search, skimCriteria, sampleCriteria, pagesize):
+        start = 0
+        while True:
+            page = search(skimCriteria, sampleCriteria, start, pagesize)
+            for entry in page:
+                yield entry
+            if len(page) < pagesize:
+                break
+            start += pagesize
+    # bulk reads
+    def readMulticall(self, method, argslist, chunksize=100):
+        """Call method of the read url once for each tuple in argslist.
+
+        The calls are bundled with system.multicall, chunksize calls per
+        request. If the server does not support multicall, the calls are
+        sent concurrently over the connection pool instead. Returns the
+        results in the order of argslist, failed calls are returned as
+        Aix3adbException instances.
+        """
+        return self._multicall(self.readProxy, method, argslist, chunksize)
+    def authMulticall(self, calls, chunksize=50):
+        """Send calls, a list of (method, args), to the authenticated url.
+
+        Works like readMulticall. If the cookie is rejected, it is renewed
+        once and only the calls which were not executed are sent again.
+        """
+        return self._multicallMixed(self.authProxy, calls, chunksize, reauthorize=True)
+    def _multicall(self, borrow, method, argslist, chunksize):
+        return self._multicallMixed(borrow, [(method, args) for args in argslist], chunksize)
+    def _multicallMixed(self, borrow, calls, chunksize, reauthorize=False):
+        calls = list(calls)
+        if not calls:
+            return []
+        if getattr(self, '_multicallSupported', True):
+            results = []
+            try:
+                for i in range(0, len(calls), chunksize):
+                    results.extend(self._multicallChunk(borrow, calls[i:i + chunksize], reauthorize))
+                return results
+            except xmlrpclib.Fault, e:
+                if results:
+                    raise
+                log.info("system.multicall not available, sending calls concurrently: " + e.faultString)
+                self._multicallSupported = False
+        def single(call):
+            method, args = call
+            try:
+                with borrow() as s:
+                    return getattr(s, method)(*args)
+            except xmlrpclib.Fault, e:
+                return Aix3adbException(e.faultString)
+            except xmlrpclib.ProtocolError, e:
+                if not reauthorize:
+                    raise
+                return e
+        cookiestamp = self.credentialManager().cookieStamp() if reauthorize else None
+        results = self._threadMap(single, calls)
+        rejected = [i for i, result in enumerate(results) if isinstance(result, xmlrpclib.ProtocolError)]
+        if rejected:
+            self.reauthorize(cookiestamp)
+            for i, result in zip(rejected, self._threadMap(single, [calls[i] for i in rejected])):
+                if isinstance(result, xmlrpclib.ProtocolError):
+                    result = Aix3adbException("Authentication failed: " + str(result))
+                results[i] = result
+        return results
+    def _multicallChunk(self, borrow, chunk, reauthorize):
+        for attempt in (0, 1):
+            cookiestamp = self.credentialManager().cookieStamp() if reauthorize else None
+            try:
+                with borrow() as s:
+                    multicall = xmlrpclib.MultiCall(s)
+                    for method, args in chunk:
+                        getattr(multicall, method)(*args)
+                    response = multicall()
+                break
+            except xmlrpclib.ProtocolError:
+                # the request was rejected before any call was executed
+                if attempt or not reauthorize:
+                    raise
+                self.reauthorize(cookiestamp)
+        results = []
+        for j in range(len(chunk)):
+            try:
+                results.append(response[j])
+            except xmlrpclib.Fault, e:
+                results.append(Aix3adbException(e.faultString))
+        return results
+    def _threadMap(self, function, iterable):
+        iterable = list(iterable)
+        pool = ThreadPool(max(1, min(self.poolsize, len(iterable))))
+        try:
+            return pool.map(function, iterable)
+        finally:
+            pool.close()
+            pool.join()
+    def _convertMultiple(self, results, convert):
+        converted = []
+        for result in results:
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if isinstance(result, dict) and "error" in result:
+                    raise Aix3adbException(result["error"])
+                converted.append(convert(result))
+            except Aix3adbException, e:
+                converted.append(e)
+            except (KeyError, TypeError), e:
+                converted.append(Aix3adbException("Unexpected response: " + str(result)))
+        return converted
+    def _latestMultiple(self, method, keys, isfinished, skimclass, sampleclass):
+        keys = list(keys)
+        results = self.readMulticall(method, [(key, isfinished) for key in keys])
+        convert = lambda result: (skimclass(result['skim']), sampleclass(result['sample']))
+        return dict(zip(keys, self._convertMultiple(results, convert)))
+    def getMCLatestSkimAndSampleBySampleMultiple(self, names, isfinished=True):
+        """Returns a dict name -> (skim, sample) or Aix3adbException."""
+        return self._latestMultiple('getMCLatestSkimAndSampleBySample', names, isfinished, MCSkim, MCSample)
+    def getDataLatestSkimAndSampleBySampleMultiple(self, names, isfinished=True):
+        """Returns a dict name -> (skim, sample) or Aix3adbException."""
+        return self._latestMultiple('getDataLatestSkimAndSampleBySample', names, isfinished, DataSkim, DataSample)
+    def getMCLatestSkimAndSampleByDatasetpathMultiple(self, datasetpaths, isfinished=True):
+        """Returns a dict datasetpath -> (skim, sample) or Aix3adbException."""
+        return self._latestMultiple('getMCLatestSkimAndSampleByDatasetpath', datasetpaths, isfinished, MCSkim, MCSample)
+    def getDataLatestSkimAndSampleByDatasetpathMultiple(self, datasetpaths, isfinished=True):
+        """Returns a dict datasetpath -> (skim, sample) or Aix3adbException."""
+        return self._latestMultiple('getDataLatestSkimAndSampleByDatasetpath', datasetpaths, isfinished, DataSkim, DataSample)
+    def _bySkimMultiple(self, method, skimids, skimclass, sampleclass):
+        skimids = list(skimids)
+        results = self.readMulticall(method, [(skimid,) for skimid in skimids])
+        convert = lambda result: (skimclass(result['skim']), sampleclass(result['sample']))
+        return dict(zip(skimids, self._convertMultiple(results, convert)))
+    def getMCSkimAndSampleBySkimMultiple(self, skimids):
+        """Returns a dict skimid -> (skim, sample) or Aix3adbException."""
+        return self._bySkimMultiple('getMCSkimAndSampleBySkim', skimids, MCSkim, MCSample)
+    def getDataSkimAndSampleBySkimMultiple(self, skimids):
+        """Returns a dict skimid -> (skim, sample) or Aix3adbException."""
+        return self._bySkimMultiple('getDataSkimAndSampleBySkim', skimids, DataSkim, DataSample)
+    def getMCSampleMultiple(self, names):
+        """Returns a dict name -> sample or Aix3adbException."""
+        names = list(names)
+        return dict(zip(names, self._convertMultiple(self.readMulticall('getMCSample', [(name,) for name in names]), MCSample)))
+    def getDataSampleMultiple(self, names):
+        """Returns a dict name -> sample or Aix3adbException."""
+        names = list(names)
+        return dict(zip(names, self._convertMultiple(self.readMulticall('getDataSample', [(name,) for name in names]), DataSample)))
+    def _searchMultiple(self, method, criteria, start, limit, skimclass, sampleclass):
+        results = self.readMulticall(method, [(skimCriteria, sampleCriteria, start, limit)
+                                              for skimCriteria, sampleCriteria in criteria])
+        def convert(result):
+            if "error" in result:
+                raise Aix3adbException(result["error"])
+            return [(skimclass(x['skim']), sampleclass(x['sample'])) for x in result]
+        return self._convertMultiple(results, convert)
+    def searchMCSkimsAndSamplesMultiple(self, criteria, start=0, limit=20):
+        """Run several searches, criteria is a list of (skimCriteria, sampleCriteria).
+
+        Returns a list with the search result or an Aix3adbException for each entry of criteria.
+        """
+        return self._searchMultiple('searchMCSkimsAndSamples', criteria, start, limit, MCSkim, MCSample)
+    def searchDataSkimsAndSamplesMultiple(self, criteria, start=0, limit=20):
+        """Run several searches, criteria is a list of (skimCriteria, sampleCriteria).
+
+        Returns a list with the search result or an Aix3adbException for each entry of criteria.
+        """
+        return self._searchMultiple('searchDataSkimsAndSamples', criteria, start, limit, DataSkim, DataSample)
+    # bulk writes
+    def upsertMCSamplesAndSkims(self, pairs):
+        """Insert or update many (sample, skim) pairs with a few requests.
+
+        A sample is edited if a sample with its name exists, otherwise it
+        is inserted. A skim is edited if it has an id, otherwise it is
+        inserted, its sampleid is set to the id of its sample. Returns a
+        list with (sample, skim) as stored in the database or an
+        Aix3adbException for each pair.
+        This is not a transaction: pairs which failed do not undo the
+        others, and a sample may be stored although its skim failed.
+        """
+        return self._upsertSamplesAndSkims('MC', pairs, MCSample, MCSkim)
+    def upsertDataSamplesAndSkims(self, pairs):
+        """Insert or update many (sample, skim) pairs, see upsertMCSamplesAndSkims."""
+        return self._upsertSamplesAndSkims('Data', pairs, DataSample, DataSkim)
+    def _upsertSamplesAndSkims(self, kind, pairs, sampleclass, skimclass):
+        pairs = list(pairs)
+        # each sample is written once, also if several skims belong to it
+        samples = {}
+        for sample, skim in pairs:
+            samples.setdefault(sample.name, sample)
+        names = samples.keys()
+        existing = dict(zip(names, self._convertMultiple(
+            self.readMulticall('get%sSample' % kind, [(name,) for name in names]), sampleclass)))
+        calls = []
+        for name in names:
+            sample = samples[name]
+            if isinstance(existing[name], Exception):
+                calls.append(('insert%sSample' % kind, (sample.__dict__,)))
+            else:
+                if not hasattr(sample, 'id'):
+                    sample.id = existing[name].id
+                calls.append(('edit%sSample' % kind, (sample.__dict__,)))
+        stored = dict(zip(names, self._convertMultiple(self.authMulticall(calls), sampleclass)))
+        # get the ids of inserted samples if the server did not return them
+        missingids = [name for name in names
+                      if not isinstance(stored[name], Exception) and not hasattr(stored[name], 'id')]
+        if missingids:
+            stored.update(zip(missingids, self._convertMultiple(
+                self.readMulticall('get%sSample' % kind, [(name,) for name in missingids]), sampleclass)))
+        calls = []
+        skimpairs = []
+        results = [None] * len(pairs)
+        for i, (sample, skim) in enumerate(pairs):
+            storedsample = stored[sample.name]
+            if isinstance(storedsample, Exception):
+                results[i] = storedsample
+                continue
+            skim.sampleid = storedsample.id
+            method = 'edit%sSkim' if hasattr(skim, 'id') else 'insert%sSkim'
+            calls.append((method % kind, (skim.__dict__,)))
+            skimpairs.append(i)
+        for i, storedskim in zip(skimpairs, self._convertMultiple(self.authMulticall(calls), skimclass)):
+            if isinstance(storedskim, Exception):
+                results[i] = storedskim
+            else:
+                results[i] = (stored[pairs[i][0].name], storedskim)
+        return results
 
 
 class aix3adbAuth(aix3adb):
@@ -238,6 +754,263 @@ class aix3adbAuth(aix3adb):
    def __del__(self):
       self.destroyauth()
 
+class aix3adbCached(aix3adb):
+    """aix3adb with a local read-through cache in a SQLite file.
+
+    Responses of the get methods are stored in the cache and reused until
+    they are older than ttl seconds (ttl None: no expiry). Writes through
+    this object invalidate the affected rows. snapshot() mirrors all MC
+    and data skims, with offline=True no request is sent to the server
+    and missing entries raise an Aix3adbException.
+    """
+    cachedMethods = ['getMCSample', 'getDataSample', 'getMCSkim', 'getDataSkim',
+                     'getMCMaxSkimID', 'getDataMaxSkimID',
+                     'getMCSkimAndSampleBySkim', 'getDataSkimAndSampleBySkim',
+                     'getMCLatestSkimAndSampleBySample', 'getDataLatestSkimAndSampleBySample',
+                     'getMCLatestSkimAndSampleByDatasetpath', 'getDataLatestSkimAndSampleByDatasetpath']
+    def __init__(self, cachefilepath='aix3adb-cache.db', ttl=24 * 3600, offline=False, **kwargs):
+        aix3adb.__init__(self, **kwargs)
+        self.cachefile = os.path.abspath(cachefilepath)
+        self.ttl = ttl
+        self.offline = offline
+        self._cachedb = None
+        self._cacheLock = threading.Lock()
+    def __getstate__(self):
+        state = aix3adb.__getstate__(self)
+        state.pop('_cachedb', None)
+        state.pop('_cacheLock', None)
+        return state
+    def __setstate__(self, state):
+        aix3adb.__setstate__(self, state)
+        self._cachedb = None
+        self._cacheLock = threading.Lock()
+    def _db(self):
+        if self._cachedb is None:
+            self._cachedb = sqlite3.connect(self.cachefile, check_same_thread=False)
+            self._cachedb.execute('CREATE TABLE IF NOT EXISTS cache (method TEXT, args TEXT, kind TEXT, '
+                                  'name TEXT, skimid TEXT, value TEXT, ts REAL, PRIMARY KEY (method, args))')
+            self._cachedb.commit()
+        return self._cachedb
+    def _cacheGet(self, method, args):
+        with self._cacheLock:
+            row = self._db().execute('SELECT value, ts FROM cache WHERE method = ? AND args = ?',
+                                     (method, cacheKey(args))).fetchone()
+        if row is None or (self.ttl is not None and not self.offline and time.time() - row[1] > self.ttl):
+            return False, None
+        return True, json.loads(row[0])
+    def _cachePutMany(self, entries):
+        rows = []
+        now = time.time()
+        for method, args, result in entries:
+            if not isinstance(result, dict) or "error" in result:
+                continue
+            sample = result.get('sample', result)
+            skim = result.get('skim', result)
+            name = sample.get('name') if isinstance(sample, dict) else None
+            skimid = skim.get('id') if isinstance(skim, dict) else None
+            rows.append((method, cacheKey(args), 'Data' if 'Data' in method else 'MC',
+                         name, None if skimid is None else str(skimid), json.dumps(result), now))
+        with self._cacheLock:
+            db = self._db()
+            db.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            db.commit()
+    def _cachePut(self, method, args, result):
+        self._cachePutMany([(method, args, result)])
+    def invalidate(self, kind, name=None, skimid=None, latest=False):
+        """Remove cached rows of kind ('MC' or 'Data').
+
+        Rows of the sample name, of the skim id and, with latest, all
+        rows of latest skims and max skim ids are removed.
+        """
+        conditions = []
+        params = [kind]
+        if name is not None:
+            conditions.append('name = ?')
+            params.append(name)
+        if skimid is not None:
+            conditions.append('skimid = ?')
+            params.append(str(skimid))
+        if latest:
+            conditions.append("method LIKE '%Latest%' OR method LIKE '%MaxSkimID'")
+        if not conditions:
+            return
+        with self._cacheLock:
+            db = self._db()
+            db.execute('DELETE FROM cache WHERE kind = ? AND (%s)' % ' OR '.join(conditions), params)
+            db.commit()
+    def clearCache(self):
+        with self._cacheLock:
+            db = self._db()
+            db.execute('DELETE FROM cache')
+            db.commit()
+    def cachedRead(self, method, args):
+        if method in self.cachedMethods:
+            found, value = self._cacheGet(method, args)
+            if found:
+                return value
+        if self.offline:
+            raise Aix3adbException("%s%r is not in the local cache" % (method, tuple(args)))
+        with aix3adb.readProxy(self) as s:
+            result = getattr(s, method)(*args)
+        if method in self.cachedMethods:
+            self._cachePut(method, args, result)
+        return result
+    # the read methods of aix3adb get their answers through the cache
+    def readProxy(self):
+        return contextlib.closing(cachingReadProxy(self))
+    def readMulticall(self, method, argslist, chunksize=100):
+        argslist = list(argslist)
+        results = [None] * len(argslist)
+        missing = []
+        for i, args in enumerate(argslist):
+            found, value = self._cacheGet(method, args) if method in self.cachedMethods else (False, None)
+            if found:
+                results[i] = value
+            elif self.offline:
+                results[i] = Aix3adbException("%s%r is not in the local cache" % (method, tuple(args)))
+            else:
+                missing.append(i)
+        fetched = self._multicall(lambda: aix3adb.readProxy(self), method,
+                                  [argslist[i] for i in missing], chunksize)
+        for i, result in zip(missing, fetched):
+            results[i] = result
+        if method in self.cachedMethods:
+            self._cachePutMany([(method, argslist[i], result) for i, result in zip(missing, fetched)
+                                if not isinstance(result, Exception)])
+        return results
+    # writes invalidate the affected rows
+    def insertMCSample(self, sample):
+        result = aix3adb.insertMCSample(self, sample)
+        self.invalidate('MC', name=sample.name)
+        return result
+    def insertDataSample(self, sample):
+        result = aix3adb.insertDataSample(self, sample)
+        self.invalidate('Data', name=sample.name)
+        return result
+    def insertMCSkim(self, skim):
+        result = aix3adb.insertMCSkim(self, skim)
+        self.invalidate('MC', skimid=getattr(result, 'id', None), latest=True)
+        return result
+    def insertDataSkim(self, skim):
+        result = aix3adb.insertDataSkim(self, skim)
+        self.invalidate('Data', skimid=getattr(result, 'id', None), latest=True)
+        return result
+    def editMCSample(self, sample):
+        result = aix3adb.editMCSample(self, sample)
+        self.invalidate('MC', name=sample.name)
+        return result
+    def editDataSample(self, sample):
+        result = aix3adb.editDataSample(self, sample)
+        self.invalidate('Data', name=sample.name)
+        return result
+    def editMCSkim(self, skim):
+        result = aix3adb.editMCSkim(self, skim)
+        self.invalidate('MC', skimid=getattr(skim, 'id', None), latest=True)
+        return result
+    def editDataSkim(self, skim):
+        result = aix3adb.editDataSkim(self, skim)
+        self.invalidate('Data', skimid=getattr(skim, 'id', None), latest=True)
+        return result
+    def deleteMCSampleByName(self, name):
+        result = aix3adb.deleteMCSampleByName(self, name)
+        self.invalidate('MC', name=name, latest=True)
+        return result
+    def deleteDataSampleByName(self, name):
+        result = aix3adb.deleteDataSampleByName(self, name)
+        self.invalidate('Data', name=name, latest=True)
+        return result
+    def deleteMCSkimById(self, skimid):
+        result = aix3adb.deleteMCSkimById(self, skimid)
+        self.invalidate('MC', skimid=skimid, latest=True)
+        return result
+    def deleteDataSkimById(self, skimid):
+        result = aix3adb.deleteDataSkimById(self, skimid)
+        self.invalidate('Data', skimid=skimid, latest=True)
+        return result
+    def upsertMCSamplesAndSkims(self, pairs):
+        pairs = list(pairs)
+        try:
+            return aix3adb.upsertMCSamplesAndSkims(self, pairs)
+        finally:
+            self._invalidateUpsert('MC', pairs)
+    def upsertDataSamplesAndSkims(self, pairs):
+        pairs = list(pairs)
+        try:
+            return aix3adb.upsertDataSamplesAndSkims(self, pairs)
+        finally:
+            self._invalidateUpsert('Data', pairs)
+    def _invalidateUpsert(self, kind, pairs):
+        for sample, skim in pairs:
+            self.invalidate(kind, name=sample.name, skimid=getattr(skim, 'id', None))
+        self.invalidate(kind, latest=True)
+    def snapshot(self, pagesize=500):
+        """Mirror all MC and data skims and samples into the cache.
+
+        The skims are requested by id, pagesize ids per request, from 1 up
+        to the maximal skim id of the server. So the snapshot does not rely
+        on a search without criteria returning all rows. Ids without a skim,
+        e.g. of deleted skims, are skipped. The latest skim of a sample is
+        taken to be the one with the highest id. Returns the number of skims
+        stored.
+        """
+        nskims = 0
+        for kind, skimclass, sampleclass in (('MC', MCSkim, MCSample), ('Data', DataSkim, DataSample)):
+            # ask the server, not the cache
+            with aix3adb.readProxy(self) as s:
+                maxskim = getattr(s, 'get%sMaxSkimID' % kind)()
+            if "error" in maxskim:
+                raise Aix3adbException(maxskim["error"])
+            maxid = int(maxskim['skim']['id'])
+            entries = [('get%sMaxSkimID' % kind, (), maxskim)]
+            latest = {}
+            latestFinished = {}
+            missing = 0
+            convert = lambda result: (skimclass(result['skim']), sampleclass(result['sample']))
+            for first in range(1, maxid + 1, pagesize):
+                skimids = range(first, min(first + pagesize, maxid + 1))
+                results = self._multicall(lambda: aix3adb.readProxy(self), 'get%sSkimAndSampleBySkim' % kind,
+                                          [(skimid,) for skimid in skimids], pagesize)
+                for skimid, pair, converted in zip(skimids, results, self._convertMultiple(results, convert)):
+                    if isinstance(converted, Exception):
+                        missing += 1
+                        continue
+                    skim, sample = converted
+                    nskims += 1
+                    entries.append(('get%sSkimAndSampleBySkim' % kind, (skimid,), pair))
+                    entries.append(('get%sSkim' % kind, (skimid,), pair['skim']))
+                    entries.append(('get%sSample' % kind, (sample.name,), pair['sample']))
+                    if sample.name not in latest or skimid > int(latest[sample.name]['skim']['id']):
+                        latest[sample.name] = pair
+                    if getattr(skim, 'isfinished', False) and int(skim.isfinished) and \
+                       (sample.name not in latestFinished or skimid > int(latestFinished[sample.name]['skim']['id'])):
+                        latestFinished[sample.name] = pair
+            if missing:
+                log.info("%d of %d %s skim ids have no skim", missing, maxid, kind)
+            for isfinished, pairs in ((False, latest), (True, latestFinished)):
+                for name, pair in pairs.iteritems():
+                    entries.append(('get%sLatestSkimAndSampleBySample' % kind, (name, isfinished), pair))
+                    datasetpath = pair['sample'].get('datasetpath')
+                    if datasetpath:
+                        entries.append(('get%sLatestSkimAndSampleByDatasetpath' % kind, (datasetpath, isfinished), pair))
+            self._cachePutMany(entries)
+        return nskims
+
+def cacheKey(args):
+    # ids are compared as strings, they are sent both ways
+    return json.dumps([unicode(arg) if isinstance(arg, (int, long)) and not isinstance(arg, bool) else arg
+                       for arg in args])
+
+class cachingReadProxy:
+    """Stands in for the read ServerProxy of an aix3adbCached object."""
+    def __init__(self, dblink):
+        self._dblink = dblink
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self._dblink.cachedRead(method, args)
+    def close(self):
+        pass
+
 class cookietransportrequest:
     """A Transport request method that retains cookies over its lifetime.
 
@@ -258,20 +1031,33 @@ class cookietransportrequest:
     # correctly with the old-style Transport class. If you make this class
     # a new-style class, Transport.__init__() won't be called.
 
-    cookies = []
+    # cookie name -> Cookie header value, a new value replaces the old one
+    cookies = {}
     def setcookies(self,cookiefile, domain):
-        self.cookies = []
+        self.cookies = {}
         jar=cookielib.MozillaCookieJar(cookiefile)
         jar.load(ignore_discard=False, ignore_expires=False)
         for cookie in jar:
             if cookie.domain==domain:
-                self.cookies.append("$Version=1; "+cookie.name+"="+cookie.value+";")
+                self.cookies[cookie.name] = "$Version=1; "+cookie.name+"="+cookie.value+";"
     def send_cookies(self, connection):
         if self.cookies:
-            for cookie in self.cookies:
+            for cookie in self.cookies.values():
                 connection.putheader("Cookie", cookie)
 
     def request(self, host, handler, request_body, verbose=0):
+        # retry request once if the kept alive connection has gone cold
+        for i in (0, 1):
+            try:
+                return self.single_request(host, handler, request_body, verbose)
+            except socket.error, e:
+                if i or e.errno not in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
+                    raise
+            except httplib.BadStatusLine:
+                if i:
+                    raise
+
+    def single_request(self, host, handler, request_body, verbose=0):
         self.verbose = verbose
 
         # issue XML-RPC request
@@ -279,29 +1065,38 @@ class cookietransportrequest:
         if verbose:
             h.set_debuglevel(1)
 
-        self.send_request(h, handler, request_body)
-        self.send_host(h, host)
-        self.send_cookies(h)
-        self.send_user_agent(h)
-        self.send_content(h, request_body)
-
-        # Deal with differences between Python 2.4-2.6 and 2.7.
-        # In the former h is a HTTP(S). In the latter it's a
-        # HTTP(S)Connection. Luckily, the 2.4-2.6 implementation of
-        # HTTP(S) has an underlying HTTP(S)Connection, so extract
-        # that and use it.
         try:
-            response = h.getresponse()
-        except AttributeError:
-            response = h._conn.getresponse()
+            self.send_request(h, handler, request_body)
+            self.send_host(h, host)
+            self.send_cookies(h)
+            self.send_user_agent(h)
+            self.send_content(h, request_body)
+
+            # Deal with differences between Python 2.4-2.6 and 2.7.
+            # In the former h is a HTTP(S). In the latter it's a
+            # HTTP(S)Connection. Luckily, the 2.4-2.6 implementation of
+            # HTTP(S) has an underlying HTTP(S)Connection, so extract
+            # that and use it.
+            try:
+                response = h.getresponse()
+            except AttributeError:
+                response = h._conn.getresponse()
+        except Exception:
+            # the connection can not be reused, the retry in request
+            # has to open a new one
+            self.close()
+            raise
 
-        # Add any cookie definitions to our list.
+        # Add any cookie definitions to our cookies, replacing older values.
+        # The instance gets its own dict, the class attribute stays empty.
+        cookies = self.__dict__.setdefault('cookies', {})
         for header in response.msg.getallmatchingheaders("Set-Cookie"):
             val = header.split(": ", 1)[1]
-            cookie = val.split(";", 1)[0]
-            self.cookies.append(cookie)
+            cookie = val.split(";", 1)[0].strip()
+            cookies[cookie.split("=", 1)[0]] = cookie
 
         if response.status != 200:
+            response.read()
             raise xmlrpclib.ProtocolError(host + handler, response.status,
                                           response.reason, response.msg.headers)
 
@@ -318,16 +1113,18 @@ class cookietransport(cookietransportrequest, xmlrpclib.Transport):
 class cookiesafetransport(cookietransportrequest, xmlrpclib.SafeTransport):
     pass
 
-def transport(uri):
+def transport(uri, cookies=True):
     """Return an appropriate Transport for the URI.
 
     If the URI type is https, return a CookieSafeTransport.
     If the type is http, return a CookieTransport.
+    Without cookies the plain xmlrpclib transports are returned, which
+    also keep the connection alive in python 2.7.
     """
     if urlparse.urlparse(uri, "http")[0] == "https":
-        return cookiesafetransport()
+        return cookiesafetransport() if cookies else xmlrpclib.SafeTransport()
     else:
-        return cookietransport()
+        return cookietransport() if cookies else xmlrpclib.Transport()
 
 # helper function to directly retrieve a dblink object
 def createDBlink(user, readOnly= True, passphrase = None):
@@ -340,3 +1137,19 @@ def createDBlink(user, readOnly= True, passphrase = None):
     if not readOnly: dblink.authorize(username = user)
     log.info( 'Authorized to database.' )
     return dblink
+
+def main():
+    parser = optparse.OptionParser("usage: %prog snapshot [options]\n\n"
+                                   "snapshot: mirror all MC and data skims into a local SQLite cache")
+    parser.add_option("--cache", default="aix3adb-cache.db", help="SQLite cache file [default: %default]")
+    parser.add_option("--pagesize", type="int", default=500, help="Number of skims per request [default: %default]")
+    (options, args) = parser.parse_args()
+    if args != ["snapshot"]:
+        parser.error("unknown command, use snapshot")
+    logging.basicConfig(level=logging.INFO)
+    dblink = aix3adbCached(options.cache)
+    nskims = dblink.snapshot(options.pagesize)
+    log.info("Stored %d skims in %s" % (nskims, dblink.cachefile))
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import sys
 import os
 import subprocess
 import cPickle
+import copy
 import shutil
 from collections import defaultdict
 import multiprocessing
@@ -11,12 +12,31 @@ import logging
 import glob
 import re
 import datetime
+import sqlite3
+import uuid
+import random
+import shlex
+import stat
+import hashlib
+import json
+import distutils.spawn
+import threading
+from multiprocessing.pool import ThreadPool
 #logging.basicConfig(level=logging.INFO)
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 #log = multiprocessing.get_logger()
 
+# scheduler shared by all submitters of a task, see Task._dosubmit
+_submissionScheduler = None
+# guards the lazy creation of Task.inputCache
+_inputCacheLock = threading.Lock()
+
+def initSubmissionWorker(scheduler):
+    global _submissionScheduler
+    _submissionScheduler = scheduler
+
 def submitWorker(job):
     job.submit()
     return job
@@ -33,6 +53,33 @@ def killWorker(job):
     job.kill()
     return job
 
+def statusWorker(jobids):
+    command = ["glite-ce-job-status", "-L1"] + jobids
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+def outputWorker(args):
+    directory, connections, jobids = args
+    command = ["glite-ce-job-output", "-s", str(connections), "--noint", "--dir", directory] + jobids
+    starttime = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr, time.time()-starttime
+
+def purgeWorker(jobids):
+    command = ["glite-ce-job-purge", "--noint"] + jobids
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+def linkFile(source, target):
+    """Hard link source to target, fall back to a symlink if source is on another file system."""
+    try:
+        os.link(source, target)
+    except OSError:
+        os.symlink(os.path.abspath(source), target)
+
 def getCernUserName():
     try:
         username = os.environ["CERNUSERNAME"]
@@ -45,57 +92,135 @@ def getCernUserName():
         except:
             raise Exception("CERN user name could not be obtained. Please specify your CERN user name using the environment variable $CERNUSERNAME.")
 
-def createAndUploadGridPack(localfiles, uploadurl, tarfile="gridpacktemp.tar.gz", uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/"):
-    # create pack file
-    command = ['tar', "zcvf", tarfile]
-    if type(localfiles) == list:
-        command.extend(localfiles)
-    else:
-        command.append(localfiles)
-    process = subprocess.Popen(command, stdout=subprocess.PIPE,env=os.environ.copy())
-    stdout, stderr = process.communicate()
-    if process.returncode!=0:
-        raise Exception ("Could not create tar file for grid pack: "+stdout+"\n"+stderr)
-    return uploadGridPack(tarfile, uploadurl, uploadsite)
+def gridPackHash(localfiles):
+    """Return the sha1 hash of the names and contents of all files below localfiles."""
+    sha1 = hashlib.sha1()
+    paths = []
+    for localfile in localfiles:
+        if os.path.isdir(localfile):
+            for dirpath, dirnames, filenames in os.walk(localfile):
+                paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+        else:
+            paths.append(localfile)
+    for path in sorted(paths):
+        sha1.update(path+"\0")
+        f = open(path, 'rb')
+        for block in iter(lambda: f.read(1<<20), ''):
+            sha1.update(block)
+        f.close()
+    return sha1.hexdigest()
 
-def uploadGridPack(tarfile, uploadurl, uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/", force=False):
+def _gridPackIndexFile():
+    return os.path.join(os.path.expanduser("~"), ".cesubmit", "gridpacks.json")
+
+def _readGridPackIndex():
+    try:
+        f = open(_gridPackIndexFile(), 'r')
+        index = json.load(f)
+        f.close()
+        return index
+    except (IOError, ValueError):
+        return dict()
+
+def _writeGridPackIndex(index):
+    filename = _gridPackIndexFile()
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    f = open(filename+".tmp", 'w')
+    json.dump(index, f, indent=1)
+    f.close()
+    os.rename(filename+".tmp", filename)
+
+def _srmExists(url):
+    process = subprocess.Popen(["srmls", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+    return process.returncode == 0
+
+def _formatUploadUrl(uploadurl, uploadsite, contenthash=None):
     replacedict=dict()
     replacedict["createdate"]=datetime.datetime.now().strftime('%Y-%m-%d')
     replacedict["createdatetime"]=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
     replacedict['username']=getCernUserName()
-
+    if contenthash is not None:
+        replacedict['contenthash']=contenthash
     resultuploadurl=uploadurl.format(**replacedict)
+    return resultuploadurl, (uploadsite).format(**replacedict)
+
+def createAndUploadGridPack(localfiles, uploadurl, tarfile="gridpacktemp.tar.gz", uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/", force=False, interactive=None):
+    if type(localfiles) != list:
+        localfiles = [localfiles]
+    # reuse a grid pack with the same content if it is still on the dCache
+    contenthash = gridPackHash(localfiles)
+    resultuploadurl, site = _formatUploadUrl(uploadurl, uploadsite, contenthash)
+    index = _readGridPackIndex()
+    key = contenthash+" "+site
+    if key in index and _srmExists(site+index[key]):
+        log.info('Grid pack with hash %s already exists: %s', contenthash, index[key])
+        return index[key]
+    if "{contenthash}" in uploadurl and _srmExists(site+resultuploadurl):
+        log.info('Grid pack with hash %s already exists: %s', contenthash, resultuploadurl)
+        index[key] = resultuploadurl
+        _writeGridPackIndex(index)
+        return resultuploadurl
+    # create pack file, with a parallel compressor if available
+    if distutils.spawn.find_executable("pigz"):
+        command = ['tar', "--use-compress-program=pigz", "-cf", tarfile]
+    else:
+        command = ['tar', "zcf", tarfile]
+    command.extend(localfiles)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=os.environ.copy())
+    stdout, stderr = process.communicate()
+    if process.returncode!=0:
+        raise Exception ("Could not create tar file for grid pack: "+stdout)
+    resultuploadurl = uploadGridPack(tarfile, uploadurl, uploadsite, force, interactive, contenthash)
+    index[key] = resultuploadurl
+    _writeGridPackIndex(index)
+    return resultuploadurl
+
+def uploadGridPack(tarfile, uploadurl, uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/", force=False, interactive=None, contenthash=None):
+    resultuploadurl, site = _formatUploadUrl(uploadurl, uploadsite, contenthash)
+    # only ask if somebody can answer
+    if interactive is None:
+        interactive = sys.stdin.isatty()
 
     #check for an existing gridpack
-    cmd = ["srmls",(uploadsite).format(**replacedict)+resultuploadurl]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    process.communicate()
-    if process.returncode == 0:
-        if not force:
-            print "File %s exists on dcache!" % ((uploadsite).format(**replacedict)+resultuploadurl)
+    if _srmExists(site+resultuploadurl):
+        if not force and interactive:
+            print "File %s exists on dcache!" % (site+resultuploadurl)
             print 'Remove? [Y/N]'
             input = raw_input('-->')
             if input == 'y' or input == 'Y':
                 force = True
+        elif not force:
+            raise Exception ("File %s exists on dcache! Use force to replace it." % (site+resultuploadurl))
         if force:
-            deleteCommand = ["srmrm",(uploadsite).format(**replacedict)+resultuploadurl]
+            deleteCommand = ["srmrm",site+resultuploadurl]
             process = subprocess.Popen(deleteCommand, stdout=subprocess.PIPE)
             process.communicate()
 
     # upload pack file
-    command = ["srmcp", "file:///"+tarfile, (uploadsite).format(**replacedict)+resultuploadurl ]
-    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    command = ["srmcp", "file:///"+tarfile, site+resultuploadurl ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdout, stderr = process.communicate()
     if process.returncode!=0:
-        raise Exception ("Could not upload grid pack: "+stdout+"\n"+stderr)
+        raise Exception ("Could not upload grid pack: "+stdout)
     return resultuploadurl
 
 
 class Job:
+    # containers which are usually changed in place, the job store compares
+    # a shallow copy of them on save because __setattr__ does not see this
+    mutableFields = ('infos', 'arguments', 'inputfiles', 'outputfiles')
     def __init__(self):
         self.inputfiles, self.outputfiles, self.arguments , self.executable = [], [], [], None
         self.frontEndStatus = ""
         self.jobid=None
+    def __setattr__(self, name, value):
+        # remember modified jobs, only those are written to the job store on save
+        self.__dict__[name] = value
+        self.__dict__['_dirty'] = True
+    def mutableState(self):
+        return tuple(copy.copy(self.__dict__.get(name)) for name in self.mutableFields)
     @property
     def status(self):
         try:
@@ -103,74 +228,45 @@ class Job:
         except:
             status="None"
         return status
-    def writeJdl(self):
-
+    def writeJdl(self, template=None):
+        if template is None:
+            template = JdlTemplate(self.task)
         if self.executable is None: self.executable = self.task.executable
         if (self.task.uploadexecutable):
             relPathExecutable = "./" + os.path.basename(self.executable)
         else:
             relPathExecutable = "./" + self.executable
-        self.executable = os.path.abspath( self.executable )
+        self.executable = template.abspath( self.executable )
         self.inputfiles = [os.path.abspath( ifile ) for ifile in self.inputfiles ]
-        jdl = (
-            '[Type = "Job";\n'
-            'VirtualOrganisation = "dcms";\n'
-            'AllowZippedISB = true;\n'
-            #'Requirements = (RegExp("rwth-aachen.de", other.GlueCEUniqueId)) && (RegExp("cream", other.GlueCEUniqueId)) && !(RegExp("short", other.GlueCEUniqueId));\n'
-            'ShallowRetryCount = 10;\n'
-            'RetryCount = 3;\n'
-            'MyProxyServer = "";\n'
-            'executable = "prologue.sh";\n'
-            'StdOutput = "out.txt";\n'
-            'StdError  = "err.txt";\n'
-            'outputsandboxbasedesturi="gsiftp://localhost";\n'
-            )
-        standardinput = ["./prologue.sh"]
-        if self.task.uploadexecutable:
-            standardinput.append(self.executable)
-        jdl += 'InputSandbox = { "' + ('", "'.join(standardinput+self.inputfiles+self.task.inputfiles)) + '"};\n'
-        stds=["out.txt", "err.txt"]
-        if not isinstance(self.outputfiles,list) or not isinstance(self.task.outputfiles,list):
+        if not isinstance(self.outputfiles,list):
             raise Exception("You passed a non list object as outputfile argument! Make a list!")
-        jdl += 'OutputSandbox = { "' + ('", "'.join(stds+self.outputfiles+self.task.outputfiles)) + '"};\n'
-        jdl += 'Arguments = "' + (' '.join([str(self.nodeid), relPathExecutable] + self.arguments)) + '";\n'
-        jdl += "]"
         self.jdlfilename = "job"+str(self.nodeid)+".jdl"
         jdl_file = open(self.jdlfilename, 'w')
-        jdl_file.write(jdl)
+        jdl_file.write(template.render(self, relPathExecutable))
         jdl_file.close()
         self.frontEndStatus = "JDLWRITTEN"
     def submit(self):
-        startdir = os.getcwd()
-        if startdir!=self.task.directory:
-            os.chdir(self.task.directory)
-
-        #get a proxy for at least 4 days
-        checkAndRenewVomsProxy(604800)
+        # in bulk mode the proxy has been checked and delegated once for the whole task
+        delegationId = getattr(self.task, 'delegationId', None)
+        if delegationId is None:
+            #get a proxy for at least 4 days
+            checkAndRenewVomsProxy(604800)
+        scheduler = _submissionScheduler
+        if scheduler is None:
+            scheduler = SubmissionScheduler()
         for i in range(50):
             #command = ['glite-ce-job-submit', '-a', '-r', 'ce201.cern.ch:8443/cream-lsf-grid_cms', self.jdlfilename]
-            command = ['glite-ce-job-submit', '-a', '-r', self.task.ceId, self.jdlfilename]
-            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            if delegationId is None:
+                command = ['glite-ce-job-submit', '-a', '-r', self.task.ceId, self.jdlfilename]
+            else:
+                command = ['glite-ce-job-submit', '-D', delegationId, '-r', self.task.ceId, self.jdlfilename]
+            generation = scheduler.acquire()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=self.task.directory)
             stdout, stderr = process.communicate()
-            if "FATAL" in stdout and "Submissions are disabled!" in stdout:
-                print "Submission server seems busy (Submissions are disabled). Waiting..."
-                time.sleep(60*(i+1))
-                continue
-            if "FATAL - jobRegister" in stdout:
-                print "Submission server seems busy (jobRegister). Waiting..."
-                time.sleep(60*(i+1))
-                continue
-            if "FATAL" in stdout and "Connection timed out" in stdout:
-                print "Submission server seems busy (Connection timed out). Waiting..."
-                time.sleep(60*(i+1))
-                continue
-            if "FATAL - EOF detected during communication" in stdout:
-                print "Submission server seems busy (EOF detected during communication). Waiting..."
-                time.sleep(60*(i+1))
-                continue
-            if "data_cb_read() - globus_ftp_client: the server responded with an error" in stdout:
-                print "Hickup in the ftp connection. Will try again. Waiting..."
-                time.sleep(60*(i+1))
+            reason = SubmissionScheduler.overloadReason(stdout)
+            scheduler.release(reason, generation)
+            if reason is not None:
+                print "Submission server seems busy (%s). Waiting..." % reason
                 continue
             if "FATAL" in stdout or "ERROR" in stdout or process.returncode != 0:
                 log.error('Submission failed.')
@@ -184,29 +280,10 @@ class Job:
                     self.jobid = line.strip()
                     log.debug("Submitted job "+self.jobid)
             break
-        os.chdir(startdir)
         return process.returncode, stdout
 
-    def runLocal(self):
-        #import stat
-        from string import Template
-        startdir = os.getcwd()
-        self.task.directory=self.task.directory.replace("bak/","")
-        if startdir!=self.task.directory:
-            os.chdir(self.task.directory)
-        jobFileName="job_local_%d"%self.nodeid
-        #if not os.path.exists(jobFileName):
-        os.mkdir(jobFileName)
-        #else:
-            #try:
-                #os.mkdir(os.path.join(self.directory,"bak"))
-            #except OSError:
-                #pass
-            #try:
-                #shutil.move(jobFileName, os.path.join(self.directory, "bak"))
-            #except OSError:
-                #pass
-        jdl_file = open(self.jdlfilename, 'r')
+    def _inputSandbox(self):
+        jdl_file = open(os.path.join(self.task.directory, self.jdlfilename), 'r')
         inputfiles=[]
         for line in jdl_file:
             if "InputSandbox" in line:
@@ -214,39 +291,65 @@ class Job:
                 line=line.split("=")[1]
                 line=line.replace("};","").replace("{","").replace('"',"").replace('./',"").replace(" ","")
                 inputfiles=line.split(",")
+        jdl_file.close()
+        return [os.path.join(self.task.directory, ifile) for ifile in inputfiles]
+
+    def prepareLocal(self):
+        """Create the working directory of a local job and return it together with the command."""
+        from string import Template
+        self.task.directory=self.task.directory.replace("bak/","")
+        jobFileName="job_local_%d"%self.nodeid
+        workdir = os.path.join(self.task.directory, jobFileName)
+        os.mkdir(workdir)
+        inputfiles = self._inputSandbox()
+        if getattr(self.task, 'inputPack', None) is not None:
+            # the task input files are not part of the sandbox if they are shipped as grid pack
+            inputfiles += self.task.inputfiles
         for file in inputfiles:
-            shutil.copy(file,jobFileName)
-        os.chdir(jobFileName)
-        for file in glob.glob("*.sh"):
-            os.system("chmod u+x %s"%file)
-            #st = os.stat(file)
-            #os.chmod(file, st.st_mode | stat.S_IEXEC)
-        d = dict(
-                VO_CMS_SW_DIR='/cvmfs/cms.cern.ch/'
-            )
-        file=open("prologue.sh","r")
-        text=file.read()
-        file.close()
-        newText=Template(text).safe_substitute(d)
-        fileNew=open("prologue.sh","w+")
-        fileNew.write(newText)
-        fileNew.close()
+            target = os.path.join(workdir, os.path.basename(file))
+            if os.path.basename(file) == "prologue.sh":
+                d = dict(
+                        VO_CMS_SW_DIR='/cvmfs/cms.cern.ch/'
+                    )
+                f=open(file,"r")
+                text=f.read()
+                f.close()
+                fileNew=open(target,"w")
+                fileNew.write(Template(text).safe_substitute(d))
+                fileNew.close()
+            elif file.endswith(".sh"):
+                # scripts are made executable, copy them to leave the original untouched
+                shutil.copy(file, target)
+            else:
+                # read-only link to the input cache, a job has to copy inputs it modifies
+                self.task.inputCache.link(file, target)
+        for file in glob.glob(os.path.join(workdir, "*.sh")):
+            os.chmod(file, os.stat(file).st_mode | stat.S_IXUSR)
 
         localargs=(' '.join(["./prologue.sh","%d"%self.nodeid,"./"+os.path.basename(self.executable)] + self.arguments))
         if "grid-dcap." in localargs:
             localargs=localargs.replace("grid-dcap.","grid-dcap-extern.")
         else:
             localargs=localargs.replace("/pnfs","dcap://grid-dcap-extern.physik.rwth-aachen.de/pnfs")
+        self.jobid=jobFileName
+        return workdir, shlex.split(localargs)
 
-        errFile=open("err.txt","w")
-        outFile=open("out.txt","w")
-        #print "run "+localargs
-        process = subprocess.Popen(localargs, stdout=outFile, stderr=errFile, shell=True )
-        #stdout, stderr = process.communicate()
-        process.communicate()
+    def runLocal(self):
+        workdir, args = self.prepareLocal()
+        errFile=open(os.path.join(workdir, "err.txt"),"w")
+        outFile=open(os.path.join(workdir, "out.txt"),"w")
+        starttime = time.time()
+        process = subprocess.Popen(args, stdout=outFile, stderr=errFile, cwd=workdir, close_fds=True)
+        # wait4 instead of wait to obtain the resource usage of the job
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
         outFile.close()
         errFile.close()
-        self.jobid=jobFileName
+        self.exitCode = process.returncode
+        self.wallTime = time.time()-starttime
+        self.cpuTime = rusage.ru_utime+rusage.ru_stime
+        self.peakRss = rusage.ru_maxrss
+        log.debug('Local job %d finished with exit code %d after %.1f s cpu time, peak rss %d kB', self.nodeid, self.exitCode, self.cpuTime, self.peakRss)
         return
 
 
@@ -315,6 +418,166 @@ class Job:
         return str(self.jobid).split("/")[-1]
 
 
+class JdlTemplate:
+    """The part of the JDL which is shared by all jobs of a task.
+
+    The header and the task input and output files are resolved once when
+    the template is created, render only adds the job specific sandbox files
+    and arguments.
+    """
+    def __init__(self, task):
+        if not isinstance(task.outputfiles,list):
+            raise Exception("You passed a non list object as outputfile argument! Make a list!")
+        self.uploadexecutable = task.uploadexecutable
+        self.header = (
+            '[Type = "Job";\n'
+            'VirtualOrganisation = "dcms";\n'
+            'AllowZippedISB = true;\n'
+            #'Requirements = (RegExp("rwth-aachen.de", other.GlueCEUniqueId)) && (RegExp("cream", other.GlueCEUniqueId)) && !(RegExp("short", other.GlueCEUniqueId));\n'
+            'ShallowRetryCount = 10;\n'
+            'RetryCount = 3;\n'
+            'MyProxyServer = "";\n'
+            'executable = "prologue.sh";\n'
+            'StdOutput = "out.txt";\n'
+            'StdError  = "err.txt";\n'
+            'outputsandboxbasedesturi="gsiftp://localhost";\n'
+            )
+        # Task.submit has already made the task input files absolute
+        if getattr(task, 'inputPack', None) is None:
+            self.inputfiles = list(task.inputfiles)
+        else:
+            self.inputfiles = []
+        self.outputfiles = ["out.txt", "err.txt"]
+        self.taskoutputfiles = task.outputfiles
+        self._abspaths = dict()
+    def abspath(self, path):
+        # all jobs usually share the executable, resolve it only once
+        try:
+            return self._abspaths[path]
+        except KeyError:
+            self._abspaths[path] = os.path.abspath(path)
+            return self._abspaths[path]
+    def render(self, job, relPathExecutable):
+        standardinput = ["./prologue.sh"]
+        if self.uploadexecutable:
+            standardinput.append(job.executable)
+        jdl = self.header
+        jdl += 'InputSandbox = { "' + ('", "'.join(standardinput+job.inputfiles+self.inputfiles)) + '"};\n'
+        jdl += 'OutputSandbox = { "' + ('", "'.join(self.outputfiles+job.outputfiles+self.taskoutputfiles)) + '"};\n'
+        jdl += 'Arguments = "' + (' '.join([str(job.nodeid), relPathExecutable] + job.arguments)) + '";\n'
+        jdl += "]"
+        return jdl
+
+
+class InputCache:
+    """Content addressed storage of sandbox files in the task directory.
+
+    Every distinct file content is stored once as inputcache/<sha1>, a
+    reflink copy where the file system supports it. The job sandboxes hard
+    link to these entries, which are read-only, so a job can not modify the
+    inputs of other jobs by writing to a file in place. Hashes are
+    remembered by path, size and modification time, so each input file is
+    read only once. Files are hashed without holding a lock and only
+    additions of the same content wait for each other.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._hashes = dict()
+        self._lock = threading.Lock()
+        # sha1 -> lock held while the entry is written
+        self._entryLocks = dict()
+    def hash(self, path):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        if key not in self._hashes:
+            sha1 = hashlib.sha1()
+            f = open(path, 'rb')
+            for block in iter(lambda: f.read(1<<20), ''):
+                sha1.update(block)
+            f.close()
+            self._hashes[key] = sha1.hexdigest()
+        return self._hashes[key]
+    def add(self, path):
+        """Store path in the cache if its content is not known yet and return the cache entry."""
+        digest = self.hash(path)
+        entry = os.path.join(self.directory, digest)
+        with self._lock:
+            entryLock = self._entryLocks.setdefault(digest, threading.Lock())
+        with entryLock:
+            if not os.path.exists(entry):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not os.path.isdir(self.directory):
+                        raise
+                # other caches on the same directory may write the same entry concurrently
+                tmp = "%s.%d.%d.tmp" % (entry, os.getpid(), threading.current_thread().ident)
+                process = subprocess.Popen(["cp", "--reflink=auto", path, tmp], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
+                process.communicate()
+                if process.returncode!=0:
+                    shutil.copy2(path, tmp)
+                os.chmod(tmp, os.stat(tmp).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                os.rename(tmp, entry)
+            return entry
+    def link(self, path, target):
+        linkFile(self.add(path), target)
+
+
+class JobStore:
+    """SQLite backed storage of the jobs of a task.
+
+    Each job is stored as one pickled row keyed by its position in the task,
+    so saving a task only rewrites the jobs that changed since the last save.
+    A job counts as changed if an attribute was assigned (Job.__setattr__)
+    or one of its Job.mutableFields differs from the state last written,
+    this also catches in place changes like job.infos['x']=...
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (position INTEGER PRIMARY KEY, jobid TEXT, state BLOB)")
+        self.connection.commit()
+        self.jobids = dict(self.connection.execute("SELECT position, jobid FROM jobs"))
+        # position -> (job, Job.mutableState) as last loaded or written
+        self.written = {}
+    def load(self):
+        jobs = []
+        for position, state in self.connection.execute("SELECT position, state FROM jobs ORDER BY position"):
+            job = Job()
+            job.__dict__.update(cPickle.loads(str(state)))
+            job.__dict__['_dirty'] = False
+            self.written[position] = (job, job.mutableState())
+            jobs.append(job)
+        return jobs
+    def write(self, jobs):
+        """Write all modified jobs, returns True if the list of job ids changed."""
+        jobidschanged = False
+        for position, job in enumerate(jobs):
+            mutableState = job.mutableState()
+            written = self.written.get(position)
+            if (not job.__dict__.get('_dirty', True) and written is not None
+                    and written[0] is job and written[1] == mutableState):
+                continue
+            state = dict((key, value) for key, value in job.__dict__.iteritems() if key not in ('task', '_dirty'))
+            jobid = None if job.jobid is None else str(job.jobid)
+            self.connection.execute("INSERT OR REPLACE INTO jobs (position, jobid, state) VALUES (?, ?, ?)",
+                (position, jobid, sqlite3.Binary(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))))
+            if position not in self.jobids or self.jobids[position] != jobid:
+                jobidschanged = True
+            self.jobids[position] = jobid
+            self.written[position] = (job, mutableState)
+            job.__dict__['_dirty'] = False
+        for position in [p for p in self.jobids if p >= len(jobs)]:
+            self.connection.execute("DELETE FROM jobs WHERE position=?", (position,))
+            del self.jobids[position]
+            self.written.pop(position, None)
+            jobidschanged = True
+        self.connection.commit()
+        return jobidschanged
+    def close(self):
+        self.connection.close()
+
+
 class Task:
     @classmethod
     def load(cls, directory):
@@ -326,7 +589,48 @@ class Task:
         # for downward compatibility with old task.pkl files. This can be removed in the future
         if not 'ceId' in obj.__dict__:
             obj.ceId = 'grid-ce.physik.rwth-aachen.de:8443/cream-pbs-cms'
+        # task.pkl files written before the job store contain all jobs, move them to the job store once
+        if obj._jobs is not None:
+            log.info('Migrate task %s to job store', obj.name)
+            obj.save()
         return obj
+    def __getstate__(self):
+        # jobs are persisted in the job store and not pickled together with the task
+        state = self.__dict__.copy()
+        state.pop('_jobs', None)
+        state.pop('_jobStore', None)
+        state.pop('_inputCache', None)
+        state.pop('submissionScheduler', None)
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._jobStore = None
+        self._inputCache = None
+        self.submissionScheduler = None
+        if 'jobs' in state:
+            self._jobs = self.__dict__.pop('jobs')
+        else:
+            self._jobs = None
+    @property
+    def jobs(self):
+        # jobs are loaded lazily from the job store on first access
+        if self._jobs is None:
+            self._jobs = self.jobStore.load()
+            for job in self._jobs:
+                job.__dict__['task'] = self
+        return self._jobs
+    @property
+    def inputCache(self):
+        if self._inputCache is None:
+            with _inputCacheLock:
+                if self._inputCache is None:
+                    self._inputCache = InputCache(os.path.join(self.directory, "inputcache"))
+        return self._inputCache
+    @property
+    def jobStore(self):
+        if self._jobStore is None:
+            self._jobStore = JobStore(os.path.join(self.directory, "jobs.db"))
+        return self._jobStore
     def __init__(self, name, directory = None, mode="RECREATE", scramArch=True, cmsswVersion=None, ceId='grid-ce.physik.rwth-aachen.de:8443/cream-pbs-cms'):
         self.name = name
         self.directory=directory
@@ -334,7 +638,8 @@ class Task:
             self.directory = name
         self.directory = os.path.abspath(self.directory)
         self.jdlfilename = name+".jdl"
-        self.inputfiles, self.outputfiles, self.jobs, self.executable = [], [], [], None
+        self.inputfiles, self.outputfiles, self.executable = [], [], None
+        self._jobs, self._jobStore, self._inputCache = [], None, None
         self.mode = mode
         if scramArch is True:
             self.scramArch = os.environ.get('SCRAM_ARCH')
@@ -345,17 +650,28 @@ class Task:
         else:
             self.cmsswVersion = cmsswVersion
         self.ceId = ceId
-        self.jobs = []
+        self.delegationId = None
+        self.submissionScheduler = None
         self.frontEndStatus=""
         self.stageOutDCache, self.gridPacks = [], []
+        self.inputPack = None
         self.uploadexecutable = True
         self.replacedict = {'username': '${CESUBMITUSERNAME}', 'nodeid': '${CESUBMITNODEID}', 'createdate': '${CESUBMITCREATEDATE}', 'createdatetime': '${CESUBMITCREATEDATETIME}', 'taskname': "${CESUBMITTASKNAME}", 'runid': "${CESUBMITRUNID}"}
     def save(self):
         log.debug('Save task %s',self.name)
-        f = open(os.path.join(self.directory, "task.pkl"), 'wb')
+        # the jobs are committed before task.pkl, which does not contain them, replaces
+        # the old file. A failed save never leaves a task whose jobs are in neither file.
+        # Only modified jobs are written, nothing to do if the jobs have not been loaded
+        jobidschanged = self._jobs is not None and self.jobStore.write(self._jobs)
+        taskfile = os.path.join(self.directory, "task.pkl")
+        f = open(taskfile + ".tmp", 'wb')
         cPickle.dump(self, f)
         f.close()
-        f = open(os.path.join(self.directory, "jobids.txt"), 'w')
+        os.rename(taskfile + ".tmp", taskfile)
+        jobidsfile = os.path.join(self.directory, "jobids.txt")
+        if self._jobs is None or (not jobidschanged and os.path.exists(jobidsfile)):
+            return
+        f = open(jobidsfile, 'w')
         for job in self.jobs:
             try:
                 f.write(str(job.jobid)+"\n")
@@ -365,7 +681,18 @@ class Task:
     def addJob(self, job):
         job.task = self
         self.jobs.append(job)
-    def submit(self, processes=0, local=False):
+    def delegateProxy(self):
+        """Delegate the proxy once to the CE of the task and return the delegation id."""
+        delegationId = "cesubmit-" + uuid.uuid4().hex
+        endpoint = self.ceId.split("/")[0]
+        command = ["glite-ce-delegate-proxy", "-e", endpoint, delegationId]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout, stderr = process.communicate()
+        if process.returncode!=0 or "ERROR" in stdout or "FATAL" in stdout:
+            raise ProxyError("Could not delegate proxy to "+endpoint+": "+stdout)
+        log.debug('Delegated proxy to %s with id %s', endpoint, delegationId)
+        return delegationId
+    def submit(self, processes=0, local=False, delegate=False):
         log.info('Submit task %s',self.name)
         self.inputfiles = [os.path.abspath( ifile ) for ifile in self.inputfiles ]
         if len(self.jobs)==0:
@@ -375,26 +702,37 @@ class Task:
         self.createdir()
         startdir = os.getcwd()
         os.chdir(self.directory)
+        checkAndRenewVomsProxy(604800)
+        if self.inputPack is not None and not local:
+            self._uploadInputPack()
         log.debug('Make prologue %s',self.name)
         self.makePrologue()
-        checkAndRenewVomsProxy(604800)
+        # bulk mode: delegate once and let all submitters reuse the delegation
+        self.delegationId = self.delegateProxy() if delegate and not local else None
         #enumerate jobs and create jdl files
         log.debug('Create %d jdl file',len(self.jobs))
-        for i in range(len(self.jobs)):
-            self.jobs[i].nodeid = i
-            self.jobs[i].writeJdl()
+        self.writeJdls()
         #multiprocessing
         if not local:
             self._dosubmit(range(len(self.jobs)), processes, submitWorker)
         else:
-            self._dosubmit(range(len(self.jobs)), processes, runWorker)
+            LocalBackend(processes).run(self.jobs)
         self.frontEndStatus="SUBMITTED"
         os.chdir(startdir)
         self.save()
+    def writeJdls(self):
+        """Enumerate the jobs and write their jdl files from one task template."""
+        template = JdlTemplate(self)
+        for i, job in enumerate(self.jobs):
+            job.nodeid = i
+            job.writeJdl(template)
     def _dosubmit(self, nodeids, processes, worker):
         jobs = [j for j in self.jobs if j.nodeid in nodeids]
+        # all submitters of this call share one scheduler, worker processes inherit it
+        self.submissionScheduler = SubmissionScheduler(max(1, processes))
+        initSubmissionWorker(self.submissionScheduler)
         if processes:
-            pool = multiprocessing.Pool(processes)
+            pool = multiprocessing.Pool(processes, initSubmissionWorker, (self.submissionScheduler,))
             result = pool.map_async(worker, jobs)
             pool.close()
             #pool.join()
@@ -407,6 +745,10 @@ class Task:
         else:
             for job in jobs:
                 worker(job)
+        initSubmissionWorker(None)
+        throttled = self.submissionScheduler.throttled()
+        if any(throttled.values()):
+            log.info('Throttled submissions of task %s: %s', self.name, ", ".join("%s: %d" % item for item in throttled.items() if item[1]))
 
     def blockTask(self):
         open(self.directory+"/.lock","a").close()
@@ -420,7 +762,7 @@ class Task:
     def isBlocked(self):
         return os.path.exists(self.directory+"/.lock")
 
-    def resubmit(self, nodeids, processes=0):
+    def resubmit(self, nodeids, processes=0, delegate=False):
         if self.isBlocked():
             return
         self.blockTask()
@@ -428,6 +770,11 @@ class Task:
             self.releaseTask()
             return
         log.info('Resubmit (some) jobs of task %s',self.name)
+        if delegate:
+            checkAndRenewVomsProxy(604800)
+            self.delegationId = self.delegateProxy()
+        else:
+            self.delegationId = None
         self._dosubmit(nodeids, processes, resubmitWorker)
         self.frontEndStatus = "SUBMITTED"
         self.save()
@@ -436,7 +783,7 @@ class Task:
 
     def resubmitLocal(self, nodeids, processes=0):
         log.debug('Finish up local (some) jobs of task %s',self.name)
-        self._dosubmit(nodeids, processes, runWorker)
+        LocalBackend(processes).run([j for j in self.jobs if j.nodeid in nodeids])
         self.frontEndStatus = "Local"
         self.save()
         self.cleanUp()
@@ -449,6 +796,23 @@ class Task:
         self.cleanUp()
     def copyResultsToDCache(self, resultfile, uploadurl="{createdate}/{taskname}/{resultfileprefix}-{nodeid}_{runid}.{resultfilesuffix}", uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/"):
         self.stageOutDCache.append((resultfile, uploadsite+uploadurl))
+    def packInputFiles(self, uploadurl="cesubmit/{createdate}/{taskname}/inputfiles-{createdatetime}.tar.gz", uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/"):
+        """Ship the task input files once as grid pack instead of in the sandbox of every job."""
+        self.inputPack = (uploadurl.replace("{taskname}", self.name), uploadsite)
+    def _uploadInputPack(self):
+        uploadurl, uploadsite = self.inputPack
+        packdir = os.path.join(self.directory, "inputpack")
+        os.mkdir(packdir)
+        for ifile in self.inputfiles:
+            self.inputCache.link(ifile, os.path.join(packdir, os.path.basename(ifile)))
+        tarfile = os.path.join(self.directory, "inputfiles.tar.gz")
+        command = ['tar', "zcf", tarfile, "-C", packdir] + [os.path.basename(ifile) for ifile in self.inputfiles]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout, stderr = process.communicate()
+        if process.returncode!=0:
+            raise Exception ("Could not create tar file for input files: "+stdout)
+        resultuploadurl = uploadGridPack(tarfile, uploadurl, uploadsite, force=True)
+        self.addGridPack(resultuploadurl, "./", uploadsite)
     def addGridPack(self, uploadurl, extractdir="./", uploadsite="srm://grid-srm.physik.rwth-aachen.de:8443/srm/managerv2\?SFN=/pnfs/physik.rwth-aachen.de/cms/store/user/{username}/"):
         self.gridPacks.append((uploadsite+uploadurl, extractdir))
     def makePrologue(self):
@@ -532,39 +896,25 @@ class Task:
         elif os.path.exists(self.directory):
             shutil.rmtree(self.directory)
         os.makedirs(self.directory)
-    def _getStatusMultiple(self):
-        totaljobs = [job for job in self.jobs if job.frontEndStatus not in ["RETRIEVED", "PURGED"]]
-        jobpackages = list(chunks(totaljobs, 100))
-        njobs = 0
-        for jobs in jobpackages:
-            jobids = [job.jobid for job in jobs if job.jobid is not None]
-            if not jobids: return 0
-            command = ["glite-ce-job-status", "-L1"] + jobids
-            process = subprocess.Popen(command, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            if process.returncode!=0:
-                log.warning('Status retrieval failed for task '+self.name)
-                log.info(stdout)
-                log.info(stderr)
-            result = parseStatusMultipleL1(stdout)
-            for job in jobs:
-                try:
-                    infos = result[job.jobid]
-                    if len(infos)>0:
-                        job.infos = infos
-                    else:
-                        log.warning('Failed to get status of job %s of task %s',job.jobid, self.name)
-                except KeyError:
+        # a job store opened before is gone together with the old directory
+        if self._jobStore is not None:
+            self._jobStore.close()
+            self._jobStore = None
+    def _getStatusMultiple(self, chunksize=100):
+        return StatusEngine(1, chunksize).queryJobs([(self, self._statusJobs())])[self]
+    def _statusJobs(self):
+        return [job for job in self.jobs if job.frontEndStatus not in ["RETRIEVED", "PURGED"] and job.jobid is not None]
+    def _applyStatus(self, jobs, result):
+        for job in jobs:
+            try:
+                infos = result[job.jobid]
+                if len(infos)>0:
+                    job.infos = infos
+                else:
                     log.warning('Failed to get status of job %s of task %s',job.jobid, self.name)
-            njobs+=len(jobids)
-        return njobs
-    def getStatus(self):
-        if self.isBlocked():
-            log.info(self.name+ " blocked ignore (if you want to update rm .lock)")
-            return self.frontEndStatus
-        self.blockTask()
-        log.debug('Get status of task %s',self.name)
-        numberOfJobs = self._getStatusMultiple()
+            except KeyError:
+                log.warning('Failed to get status of job %s of task %s',job.jobid, self.name)
+    def _updateFrontEndStatus(self, numberOfJobs):
         oldfestatus = self.frontEndStatus
         retrieved, done, running, purged = True, True, False, True
         for job in self.jobs:
@@ -583,41 +933,22 @@ class Task:
         elif purged: self.frontEndStatus="PURGED"
         if numberOfJobs > 0 or oldfestatus != self.frontEndStatus:
             self.save()
-        self.releaseTask()
-        return self.frontEndStatus
+    def getStatus(self, processes=1, chunksize=100):
+        return StatusEngine(processes, chunksize).getStatus([self])[0]
 
-    def getOutput(self, connections=1):
+    def getOutput(self, connections=1, processes=1, chunksize=100):
         if self.isBlocked():
             return
         self.blockTask()
-        jobs = [job for job in self.jobs if job.status=="DONE-OK" and job.frontEndStatus not in ["RETRIEVED", "PURGED"]]
-        if not jobs:
+        try:
+            jobs = [job for job in self.jobs if job.status=="DONE-OK" and job.frontEndStatus not in ["RETRIEVED", "PURGED"] and job.jobid is not None]
+            if not jobs:
+                return
+            log.info('Get output of %s jobs of task %s',str(len(jobs)), self.name)
+            OutputRetriever(processes, chunksize, connections).retrieve(self, jobs)
+            self.save()
+        finally:
             self.releaseTask()
-            return
-        jobpackages = list(chunks(jobs, 100))
-        log.info('Get output of %s jobs of task %s',str(len(jobs)), self.name)
-        for jobpackage in jobpackages:
-            jobids = [job.jobid for job in jobpackage if job.jobid is not None]
-            command = ["glite-ce-job-output", "-s", str(connections), "--noint", "--dir", self.directory] + jobids
-            process = subprocess.Popen(command, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            if process.returncode!=0:
-                log.warning('Output retrieval failed for task '+self.name)
-                log.info(stdout)
-                log.info(stderr)
-            else:
-                succesfulljobids = parseGetOutput(stdout)
-                log.info('Retrieved %s jobs for %s', str(len(succesfulljobids)),self.name)
-                for job in jobpackage:
-                    if job.jobid in succesfulljobids:
-                        job.purge()
-                        job.frontEndStatus = "RETRIEVED"
-                        log.debug('Successfully retrieved job %s', job.jobid)
-                    else:
-                        job.frontEndStatus = "FAILED2RETRIEVE"
-                        log.warning('Failed to retrieve job %s', job.jobid)
-        self.save()
-        self.releaseTask()
 
     def jobStatusNumbers(self):
         jobStatusNumbers=defaultdict(int)
@@ -644,7 +975,8 @@ class Task:
         log.debug('Cleaning up task %s',self.name)
         subdirs=[job.outputSubDirectory for job in self.jobs if job.jobid is not None]
         for checkdir in glob.glob(os.path.join(self.directory,"*")):
-            if os.path.isdir(checkdir) and os.path.basename(checkdir)!="bak":
+            # the input cache and pack belong to the task and are kept in place
+            if os.path.isdir(checkdir) and os.path.basename(checkdir) not in ("bak", "inputcache", "inputpack"):
                 if os.path.basename(checkdir) not in subdirs:
                     try:
                         os.mkdir(os.path.join(self.directory,"bak"))
@@ -652,6 +984,293 @@ class Task:
                         pass
                     shutil.move(checkdir, os.path.join(self.directory, "bak"))
 
+class StatusEngine:
+    """Poll the status of the jobs of many tasks in one pass.
+
+    The glite-ce-job-status -L1 queries of all tasks are split into chunks of
+    chunksize job ids and run concurrently on a pool of at most processes
+    threads. The results are written back to Job.infos and afterwards
+    Task.frontEndStatus is updated and the task is saved if needed.
+    """
+    def __init__(self, processes=8, chunksize=100):
+        self.processes = max(1, processes)
+        self.chunksize = chunksize
+    def queryJobs(self, taskjobs):
+        """Query the status of the given (task, jobs) pairs.
+
+        Returns a dict with the number of queried jobs for each task.
+        """
+        packages = []
+        for task, jobs in taskjobs:
+            for jobpackage in chunks(jobs, self.chunksize):
+                packages.append((task, jobpackage))
+        results = threadMap(statusWorker, self.processes, [[job.jobid for job in jobpackage] for task, jobpackage in packages])
+        njobs = defaultdict(int)
+        for (task, jobpackage), (returncode, stdout, stderr) in zip(packages, results):
+            if returncode!=0:
+                log.warning('Status retrieval failed for task '+task.name)
+                log.info(stdout)
+                log.info(stderr)
+            task._applyStatus(jobpackage, parseStatusMultipleL1(stdout))
+            njobs[task] += len(jobpackage)
+        return njobs
+    def getStatus(self, tasks):
+        """Update the status of all unfinished jobs of the given tasks.
+
+        Blocked tasks are skipped. Returns the list of the task front end
+        states in the order of tasks.
+        """
+        active = []
+        for task in tasks:
+            if task.isBlocked():
+                log.info(task.name+ " blocked ignore (if you want to update rm .lock)")
+                continue
+            task.blockTask()
+            active.append(task)
+        try:
+            log.debug('Get status of %d tasks', len(active))
+            njobs = self.queryJobs([(task, task._statusJobs()) for task in active])
+            for task in active:
+                task._updateFrontEndStatus(njobs[task])
+        finally:
+            for task in active:
+                task.releaseTask()
+        return [task.frontEndStatus for task in tasks]
+class StatusWatcher:
+    """Poll the job states of many tasks adaptively and notify subscribers about changes.
+
+    The time of the last status change of a job is taken from the status
+    history of glite-ce-job-status -L1. Jobs in pending or running states are
+    polled every activeinterval seconds. Idle and held jobs, and jobs whose
+    last change is older than stableafter seconds, are polled only every
+    idleinterval seconds. Jobs in final states are not polled anymore.
+    Subscribers are called with (task, job, oldstatus, newstatus) for every
+    status change.
+    """
+    finalstates = ["DONE-OK", "DONE-FAILED", "ABORTED", "CANCELLED"]
+    idlestates = ["IDLE", "HELD"]
+    def __init__(self, engine=None, activeinterval=120, idleinterval=1800, stableafter=3600):
+        self.engine = engine if engine is not None else StatusEngine()
+        self.activeinterval, self.idleinterval, self.stableafter = activeinterval, idleinterval, stableafter
+        self.subscribers = []
+        self.lastPolled = dict()
+        self.queried, self.skipped = 0, 0
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+    def lastChange(self, job):
+        try:
+            return float(job.infos["history"][-1][1])
+        except (AttributeError, KeyError, IndexError, ValueError):
+            return None
+    def isDue(self, job, now):
+        status = job.status
+        if status in self.finalstates:
+            return False
+        lastpolled = self.lastPolled.get(job.jobid)
+        if lastpolled is None or status == "None":
+            return True
+        lastchange = self.lastChange(job)
+        if status in self.idlestates or lastchange is None or now-lastchange > self.stableafter:
+            return now-lastpolled >= self.idleinterval
+        return now-lastpolled >= self.activeinterval
+    def poll(self, tasks):
+        """Query all due jobs of tasks, emit change events and return the number of queried jobs."""
+        now = time.time()
+        taskjobs = []
+        for task in tasks:
+            if task.isBlocked():
+                log.info(task.name+ " blocked ignore (if you want to update rm .lock)")
+                continue
+            jobs = task._statusJobs()
+            due = [job for job in jobs if self.isDue(job, now)]
+            self.skipped += len(jobs)-len(due)
+            if due:
+                task.blockTask()
+                taskjobs.append((task, due))
+        try:
+            oldstatus = dict((job.jobid, job.status) for task, jobs in taskjobs for job in jobs)
+            njobs = self.engine.queryJobs(taskjobs)
+            for task, jobs in taskjobs:
+                for job in jobs:
+                    self.lastPolled[job.jobid] = now
+                    if job.status != oldstatus[job.jobid]:
+                        for callback in self.subscribers:
+                            callback(task, job, oldstatus[job.jobid], job.status)
+                task._updateFrontEndStatus(njobs[task])
+        finally:
+            for task, jobs in taskjobs:
+                task.releaseTask()
+        queried = sum(len(jobs) for task, jobs in taskjobs)
+        self.queried += queried
+        return queried
+
+
+class SubmissionScheduler:
+    """Task wide scheduler for the submissions to the CE.
+
+    All submitters share one circuit breaker. If the CE signals an overload,
+    the breaker opens and all submitters wait for a jittered, exponentially
+    growing delay. Afterwards only one submission at a time is let through
+    and the number of concurrent submissions ramps up by one with every
+    successful submission. Submissions that were already running when the
+    breaker opened do not open it again, so concurrent refusals of one
+    overload only count once for the backoff. The state is kept in shared
+    memory, so the scheduler can be used from the processes of a
+    multiprocessing pool that inherit it.
+    """
+    # overload reasons and the strings identifying them in the submission output
+    overloads = [
+        ("Submissions are disabled", ["FATAL", "Submissions are disabled!"]),
+        ("jobRegister", ["FATAL - jobRegister"]),
+        ("Connection timed out", ["FATAL", "Connection timed out"]),
+        ("EOF detected during communication", ["FATAL - EOF detected during communication"]),
+        ("ftp connection", ["data_cb_read() - globus_ftp_client: the server responded with an error"]),
+    ]
+    def __init__(self, submitters=1, basedelay=60., maxdelay=3600.):
+        self.submitters = submitters
+        self.basedelay, self.maxdelay = basedelay, maxdelay
+        self._lock = multiprocessing.Lock()
+        self._running = multiprocessing.Value('i', 0, lock=False)
+        self._allowed = multiprocessing.Value('i', submitters, lock=False)
+        self._failures = multiprocessing.Value('i', 0, lock=False)
+        self._generation = multiprocessing.Value('i', 0, lock=False)
+        self._openuntil = multiprocessing.Value('d', 0., lock=False)
+        self._throttled = multiprocessing.Array('i', len(self.overloads), lock=False)
+    @classmethod
+    def overloadReason(cls, stdout):
+        """Return the overload reason found in the output of glite-ce-job-submit or None."""
+        for reason, patterns in cls.overloads:
+            if all(pattern in stdout for pattern in patterns):
+                return reason
+        return None
+    def acquire(self):
+        """Block until the breaker is closed and a submission slot is free.
+
+        Returns the breaker generation, which has to be passed to release().
+        """
+        while True:
+            with self._lock:
+                wait = self._openuntil.value - time.time()
+                if wait <= 0 and self._running.value < self._allowed.value:
+                    self._running.value += 1
+                    return self._generation.value
+            time.sleep(max(wait, 0.) + random.uniform(0.1, 1.))
+    def release(self, reason=None, generation=None):
+        """Free the submission slot, reason is the overload reason if the CE refused the submission.
+
+        generation is the value returned by acquire(). Results of submissions
+        acquired before the breaker opened last neither reset nor extend the
+        backoff.
+        """
+        with self._lock:
+            self._running.value -= 1
+            current = generation is None or generation == self._generation.value
+            if reason is None:
+                if current:
+                    self._failures.value = 0
+                    self._allowed.value = min(self.submitters, self._allowed.value + 1)
+                return
+            self._throttled[[r for r, p in self.overloads].index(reason)] += 1
+            if not current:
+                return
+            self._generation.value += 1
+            self._failures.value += 1
+            delay = min(self.maxdelay, self.basedelay * 2**(self._failures.value-1)) * random.uniform(0.5, 1.5)
+            self._openuntil.value = max(self._openuntil.value, time.time() + delay)
+            self._allowed.value = 1
+        log.info('CE overloaded (%s), pausing all submissions for %d s', reason, delay)
+    def throttled(self):
+        """Return a dict with the number of throttled submissions per overload reason."""
+        return dict((reason, self._throttled[i]) for i, (reason, patterns) in enumerate(self.overloads))
+    def isOpen(self):
+        return self._openuntil.value > time.time()
+
+
+class LocalBackend:
+    """Run the jobs of a task on the local machine.
+
+    Every job runs in its own working directory below the task directory and
+    the working directory of the python process is never changed, so up to
+    cores jobs run concurrently from threads of one process. Sandbox files
+    are linked instead of copied. Wall time, CPU time and peak RSS (in kB)
+    of each job are stored in Job.wallTime, Job.cpuTime and Job.peakRss.
+    With cores=0 the jobs run one after another as before, cores=None uses
+    all cores of the machine.
+    """
+    def __init__(self, cores=None):
+        self.cores = multiprocessing.cpu_count() if cores is None else max(1, cores)
+    def run(self, jobs):
+        log.info('Run %d jobs locally on %d cores', len(jobs), self.cores)
+        threadMap(runWorker, self.cores, list(jobs))
+
+
+class OutputRetriever:
+    """Retrieve the output sandboxes of finished jobs in a pipeline.
+
+    Chunks of chunksize jobs are fetched concurrently with glite-ce-job-output
+    on processes threads. Successfully retrieved jobs are purged in batches of
+    purgechunksize job ids while the remaining chunks are still downloading.
+    glite-ce-job-output only reports the wall time of a whole chunk, the
+    average share of each job, chunk time divided by chunk size, is stored
+    in Job.averageRetrievalTime. The statistics of the last retrieval,
+    including the wall time of every chunk, are kept in stats.
+    """
+    def __init__(self, processes=4, chunksize=100, connections=1, purgechunksize=100):
+        self.processes = max(1, processes)
+        self.chunksize = chunksize
+        self.connections = connections
+        self.purgechunksize = purgechunksize
+        self.stats = dict()
+    def retrieve(self, task, jobs):
+        jobpackages = list(chunks(jobs, self.chunksize))
+        starttime = time.time()
+        pool = ThreadPool(min(self.processes, len(jobpackages)))
+        purgepool = ThreadPool(1)
+        purges, purgebuffer = [], []
+        retrieved, failed = 0, 0
+        chunktimes = []
+        try:
+            results = pool.imap(outputWorker, [(task.directory, self.connections, [job.jobid for job in jobpackage]) for jobpackage in jobpackages])
+            for jobpackage, (returncode, stdout, stderr, duration) in zip(jobpackages, results):
+                if returncode!=0:
+                    log.warning('Output retrieval failed for task '+task.name)
+                    log.info(stdout)
+                    log.info(stderr)
+                    continue
+                chunktimes.append(duration)
+                succesfulljobids = set(parseGetOutput(stdout))
+                log.info('Retrieved %s jobs for %s', str(len(succesfulljobids)),task.name)
+                for job in jobpackage:
+                    if job.jobid in succesfulljobids:
+                        job.frontEndStatus = "RETRIEVED"
+                        job.averageRetrievalTime = duration/len(jobpackage)
+                        purgebuffer.append(job.jobid)
+                        retrieved += 1
+                        log.debug('Successfully retrieved job %s', job.jobid)
+                    else:
+                        job.frontEndStatus = "FAILED2RETRIEVE"
+                        failed += 1
+                        log.warning('Failed to retrieve job %s', job.jobid)
+                while len(purgebuffer) >= self.purgechunksize:
+                    purges.append(purgepool.apply_async(purgeWorker, (purgebuffer[:self.purgechunksize],)))
+                    purgebuffer = purgebuffer[self.purgechunksize:]
+            if purgebuffer:
+                purges.append(purgepool.apply_async(purgeWorker, (purgebuffer,)))
+            for purge in purges:
+                returncode, stdout, stderr = purge.get()
+                if returncode!=0:
+                    log.warning('Purging failed for some jobs of task '+task.name)
+                    log.info(stdout)
+        finally:
+            pool.close()
+            purgepool.close()
+            pool.join()
+            purgepool.join()
+        duration = time.time()-starttime
+        self.stats = {"jobs": len(jobs), "retrieved": retrieved, "failed": failed, "time": duration,
+            "throughput": retrieved/duration if duration > 0 else 0., "chunktimes": chunktimes}
+        log.info('Retrieved %d jobs of task %s in %.1f s (%.2f jobs/s)', retrieved, task.name, duration, self.stats["throughput"])
+        return self.stats
 
 
 def parseGetOutput(stdout):
@@ -720,6 +1339,18 @@ def parseStatusMultipleL1(stdout):
             result[jobid][key] = value
     return result
 
+def threadMap(function, processes, iterable):
+    """ Map function on iterable using a pool of at most processes threads.
+    """
+    if processes > 1 and len(iterable) > 1:
+        pool = ThreadPool(min(processes, len(iterable)))
+        try:
+            return pool.map(function, iterable)
+        finally:
+            pool.close()
+            pool.join()
+    return map(function, iterable)
+
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
     """
@@ -4,7 +4,7 @@
 #
 # This module provides common functions for tasks with crab3.
 # You need no create a CrabController object in order to use the functions
-import os,sys,glob
+import os,sys,glob,re
 import tarfile
 import xml.etree.ElementTree as ET
 import imp
@@ -13,14 +13,23 @@ import subprocess
 import logging
 import datetime
 import uuid
+import cPickle
+import json
+import time
+import itertools
+import threading
+from Queue import Empty
+from multiprocessing.pool import ThreadPool
 from  httplib import HTTPException
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pool
 from CRABAPI.RawCommand import crabCommand
 from CRABClient.UserUtilities import getConsoleLogLevel, setConsoleLogLevel
 from CRABClient.ClientUtilities import LOGLEVEL_MUTE
 from CRABClient.ClientExceptions import CachefileNotFoundException
 setConsoleLogLevel(LOGLEVEL_MUTE)
 
+## Lock for readCrabConfig, imp.load_source is not safe to call from several threads
+_crabConfigLock = threading.Lock()
 
 
 import gridFunctions
@@ -39,8 +48,14 @@ class CrabController():
     # @param self: The object pointer.
     # @type self: A logging logger instance
     # @param self: A previously defined logger. Crab log messages will use this logger as their parent logger.
-    def __init__(self, debug=0, logger = None , workingArea = None, voGroup = None, username = None):
+    # @type workerPool: CrabWorkerPool
+    # @param workerPool: Pool of persistent crab worker processes used for all crab commands [default: new process per command]
+    # @type statusCache: CrabStatusCache
+    # @param statusCache: Cache for the results of status calls [default: no cache]
+    def __init__(self, debug=0, logger = None , workingArea = None, voGroup = None, username = None, workerPool = None, statusCache = None):
         self.debug = debug
+        self.workerPool = workerPool
+        self.statusCache = statusCache
         if workingArea is not None:
             self.workingArea = workingArea
         else:
@@ -112,6 +127,11 @@ class CrabController():
         else:
             res = self.callCrabCommand(('submit','--wait' , name))
             self.logger.info("crab sumbit called for task %s"%name)
+            if self.statusCache is not None:
+                taskname = os.path.basename( name )
+                if taskname.startswith( "crab_" ): taskname = taskname[len("crab_"):]
+                if taskname.endswith( "_cfg.py" ): taskname = taskname[:-len("_cfg.py")]
+                self.statusCache.invalidate( taskname )
             if self.debug > 1:
                 self.logger.info(str(res))
         return res
@@ -136,6 +156,8 @@ class CrabController():
             cmd = ('resubmit','--wait', os.path.join(self.workingArea,self._prepareFoldername(name)) )
         res = self.callCrabCommand( cmd )
         self.logger.info("crab resumbit called for task %s"%name)
+        if self.statusCache is not None:
+            self.statusCache.invalidate( name )
         return res
     ## Returns the hn name for a user with valid proxy
     #
@@ -166,31 +188,63 @@ class CrabController():
         if self.dry_run:
             self.logger.info('Dry-run: Created config file. crab command would have been: %s'%cmd)
         else:
+            if self.statusCache is not None:
+                result = self.statusCache.get( name )
+                if result is not None:
+                    return result
             try:
                 res = self.callCrabCommand( ('status', '--long', 'crab_%s' % name) )
                 #print res
                 if 'taskFailureMsg' in res and 'jobs' in res:
-                    return res['status'], res['jobs'], res['taskFailureMsg']
+                    result = res['status'], res['jobs'], res['taskFailureMsg']
                 elif 'jobs' in res and 'taskFailureMsg' not in res:
-                    return res['status'], res['jobs'],None
+                    result = res['status'], res['jobs'],None
                 elif 'jobs' not in res and 'taskFailureMsg' in res:
-                    return res['status'], {},res['taskFailureMsg']
+                    result = res['status'], {},res['taskFailureMsg']
                 else:
-                     return res['status'],{},None
+                    result = res['status'],{},None
+                if self.statusCache is not None:
+                    self.statusCache.put( name, result )
+                return result
             except Exception as e:
                 print e
                 self.logger.error("Can not run crab status request")
                 return "NOSTATE",{},None
 
-    ## Call crab command in a new process and return result dict
+    ## Check crab status of several tasks concurrently
+    #
+    # The number of simultaneous requests is limited by the worker pool
+    # or by maxInFlight if no worker pool is used.
+    # @type self: CrabController
+    # @param self: The object pointer.
+    # @type names list of strings
+    # @param names The crab3 request names, a.k.a the sample names
+    # @param maxInFlight Maximum number of simultaneous status requests without worker pool
+    # @return A dictionary with the status tuple for each name
+    def statusMultiple(self, names, maxInFlight = 4):
+        if self.workerPool is not None:
+            maxInFlight = self.workerPool.maxInFlight
+        pool = ThreadPool( max( 1, min( maxInFlight, len(names) ) ) )
+        try:
+            results = pool.map( self.status, names )
+        finally:
+            pool.close()
+            pool.join()
+        return dict( zip( names, results ) )
+
+    ## Call crab command in a new process or in the worker pool and return result dict
     #
     # @param self The object pointer
     # @param crabArgs A list of arguments for crab beginning with the command
     def callCrabCommand( self, crabArgs ):
-        crabCommandProcessArgs = (self.crab_q, crabArgs)
+        if self.workerPool is not None:
+            return self.workerPool.call( crabArgs )
+        # one queue per call, the controller may be shared by several threads
+        crab_q = Queue()
+        crabCommandProcessArgs = (crab_q, crabArgs)
         p = Process(target=crabCommandProcess, args=(crabCommandProcessArgs))
         p.start()
-        res = self.crab_q.get()
+        res = crab_q.get()
         p.join()
         return res
 
@@ -215,10 +269,17 @@ class CrabController():
     def readCrabConfig( self, name ):
         try:
             pset = 'crab_%s_cfg.py' % name
-            with open( pset, 'r') as cfgfile:
-                cfo = imp.load_source("pycfg", pset, cfgfile )
-                config = cfo.config
-                del cfo
+            # every config is loaded as its own module, so concurrent reads
+            # of different tasks can not replace each other's config
+            modname = "pycfg_" + uuid.uuid4().hex
+            with _crabConfigLock:
+                try:
+                    with open( pset, 'r') as cfgfile:
+                        cfo = imp.load_source( modname, pset, cfgfile )
+                    config = cfo.config
+                    del cfo
+                finally:
+                    sys.modules.pop( modname, None )
             return config
         except:
             return False
@@ -289,6 +350,109 @@ class CrabController():
 
         return parser
 
+## Cache for the results of CrabController.status
+#
+# Results are kept per task name for ttl seconds. Failed requests and
+# FAILED tasks are not cached, so a retry asks the server again. The cache is thread safe
+# and can be saved to and loaded from a snapshot file, so a restarted
+# monitor starts with the last known states. Entries loaded from a
+# snapshot are used for snapshotTtl seconds after they were queried,
+# until the task is queried again. hits and misses count the
+# lookups answered from the cache and the ones passed on to the server.
+class CrabStatusCache:
+    ## Status results which are never cached
+    uncachedStates = [ 'FAILED', 'NOSTATE', 'CrabCommandError', 'YouAreFuckedByCrab', 'CachefileNotFound' ]
+
+    ## The constructor.
+    #
+    # @type self: CrabStatusCache
+    # @param self: The object pointer.
+    # @param ttl Time in seconds for which a status result is valid
+    # @param snapshotFile File to save the cache to, it is read on creation if it exists [default: none]
+    # @param snapshotTtl Time in seconds for which a status result loaded from a snapshot is valid
+    def __init__(self, ttl = 60, snapshotFile = None, snapshotTtl = 3600):
+        self.ttl = ttl
+        self.snapshotFile = snapshotFile
+        self.snapshotTtl = snapshotTtl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._fromSnapshot = set()
+        self._lock = threading.Lock()
+        if snapshotFile is not None and os.path.exists( snapshotFile ):
+            self.load()
+
+    ## Return the cached status of a task or None if unknown or expired
+    #
+    # @param self: The object pointer.
+    # @param name The crab3 request name
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get( name )
+            ttl = self.snapshotTtl if name in self._fromSnapshot else self.ttl
+            if entry is not None and time.time() - entry[0] < ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    ## Store the status of a task
+    #
+    # @param self: The object pointer.
+    # @param name The crab3 request name
+    # @param result The status tuple returned by CrabController.status
+    def put(self, name, result):
+        if result[0] in self.uncachedStates:
+            self.invalidate( name )
+            return
+        with self._lock:
+            self._entries[ name ] = ( time.time(), result )
+            self._fromSnapshot.discard( name )
+
+    ## Drop the status of a task or of all tasks if no name is given
+    #
+    # @param self: The object pointer.
+    # @param name The crab3 request name
+    def invalidate(self, name = None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+                self._fromSnapshot.clear()
+            else:
+                self._entries.pop( name, None )
+                self._fromSnapshot.discard( name )
+
+    ## Save the cache to a snapshot file
+    #
+    # @param self: The object pointer.
+    # @param filename The snapshot file [default: snapshotFile]
+    def save(self, filename = None):
+        filename = filename if filename is not None else self.snapshotFile
+        with self._lock:
+            with open( filename + ".tmp", 'wb' ) as snapshot:
+                cPickle.dump( self._entries, snapshot, cPickle.HIGHEST_PROTOCOL )
+        os.rename( filename + ".tmp", filename )
+
+    ## Load the cache from a snapshot file
+    #
+    # @param self: The object pointer.
+    # @param filename The snapshot file [default: snapshotFile]
+    def load(self, filename = None):
+        filename = filename if filename is not None else self.snapshotFile
+        with open( filename, 'rb' ) as snapshot:
+            entries = cPickle.load( snapshot )
+        with self._lock:
+            self._entries.update( entries )
+            self._fromSnapshot.update( entries )
+
+    ## Return a dictionary with the number of hits and misses and the hit rate
+    #
+    # @param self: The object pointer.
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { 'hits':self.hits, 'misses':self.misses,
+                 'hitrate':float( self.hits ) / lookups if lookups else 0. }
+
 ## Function to run crab command in a new process
 #
 # Some CRAB commands (e.g. submit) create broken cmssw process objects
@@ -296,6 +460,13 @@ class CrabController():
 # Running them in a new process is a workaround, see
 # https://twiki.cern.ch/twiki/bin/view/CMSPublic/CRAB3FAQ#Multiple_submission_fails_with_a
 def crabCommandProcess(q,crabCommandArgs):
+    q.put( runCrabCommand( crabCommandArgs ) )
+
+## Function to run a crab command with retries on server glitches
+#
+# @param crabCommandArgs A list of arguments for crab beginning with the command
+# @return The result dict of the crab command
+def runCrabCommand(crabCommandArgs):
     # give crab3 the chance for one server glitch
     i=0
     while True:
@@ -320,7 +491,311 @@ def crabCommandProcess(q,crabCommandArgs):
         if i>5:
             res={ 'status':"YouAreFuckedByCrab",'jobs':{}}
             break
-    q.put( res )
+    return res
+
+## Crab commands which need a fresh process, see crabCommandProcess
+freshProcessCommands = ['submit']
+
+## Main loop of a persistent crab worker process
+#
+# The worker reads (commandId, crabCommandArgs) tuples from its command
+# queue and reports start and result of every command on the result queue.
+# It exits after maxCommands commands, after one of the freshProcessCommands,
+# after an unexpected error or if it reads None, and reports its exit to the
+# pool which starts a new worker.
+# @param workerId The id of the worker in the pool
+# @param commands The command queue of this worker
+# @param results The result queue
+# @param maxCommands Number of commands after which the worker is recycled
+def crabWorkerProcess(workerId, commands, results, maxCommands):
+    for i in range(maxCommands):
+        item = commands.get()
+        if item is None:
+            break
+        commandId, crabCommandArgs = item
+        results.put( ('start', workerId, commandId, None) )
+        try:
+            res = runCrabCommand( crabCommandArgs )
+        except Exception as e:
+            results.put( ('done', workerId, commandId, { 'status':"CrabCommandError", 'jobs':{}, 'error':str(e) }) )
+            break
+        results.put( ('done', workerId, commandId, res) )
+        if crabCommandArgs[0] in freshProcessCommands:
+            break
+    results.put( ('exit', workerId, None, None) )
+
+## Pool of persistent crab worker processes
+#
+# The crab commands run in worker processes which are reused for many
+# commands. Commands which are known to fail when repeated in one process,
+# see freshProcessCommands and crabCommandProcess, are the last command of
+# their worker, so each of them runs in a process of its own. Workers are
+# also recycled after maxCommands commands or after an error. The pool is thread
+# safe; at most maxInFlight commands are handed to the workers at once.
+# Every command is dispatched to an idle worker through the queue of that
+# worker, so the pool knows which command each worker holds. If a worker
+# exits or dies before it started its command, the command is handed to
+# another worker; if it dies while running it, the command fails.
+class CrabWorkerPool:
+
+    ## The constructor.
+    #
+    # @type self: CrabWorkerPool
+    # @param self: The object pointer.
+    # @param processes Number of worker processes
+    # @param maxCommands Number of commands after which a worker is replaced
+    # @param maxInFlight Maximum number of simultaneous commands [default: processes]
+    def __init__(self, processes = 4, maxCommands = 50, maxInFlight = None):
+        self.processes = processes
+        self.maxCommands = maxCommands
+        self.maxInFlight = maxInFlight if maxInFlight is not None else processes
+        self._results = Queue()
+        self._inFlight = threading.BoundedSemaphore( self.maxInFlight )
+        self._condition = threading.Condition()
+        self._responses = {}
+        # commands waiting for an idle worker
+        self._pending = []
+        # workerId -> ( commandId, crabArgs, started ) of the command handed to the worker
+        self._busy = {}
+        self._idle = []
+        self._workers = {}
+        self._queues = {}
+        self._commandIds = itertools.count()
+        self._workerIds = itertools.count()
+        self._closed = False
+        with self._condition:
+            for i in range( processes ):
+                self._startWorker()
+        self._collector = threading.Thread( target = self._collect )
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _startWorker(self):
+        workerId = next( self._workerIds )
+        commands = Queue()
+        p = Process( target=crabWorkerProcess, args=( workerId, commands, self._results, self.maxCommands ) )
+        p.daemon = True
+        p.start()
+        self._workers[ workerId ] = p
+        self._queues[ workerId ] = commands
+        self._idle.append( workerId )
+        self._dispatch()
+
+    ## Hand pending commands to idle workers, called with the condition held
+    def _dispatch(self):
+        while self._pending and self._idle:
+            workerId = self._idle.pop()
+            commandId, crabArgs = self._pending.pop( 0 )
+            self._busy[ workerId ] = ( commandId, crabArgs, False )
+            self._queues[ workerId ].put( ( commandId, crabArgs ) )
+
+    ## Remove a worker which exited or died, called with the condition held
+    #
+    # A command the worker did not start yet is handed to another worker,
+    # a command it was running fails.
+    def _removeWorker(self, workerId):
+        p = self._workers.pop( workerId, None )
+        self._queues.pop( workerId, None )
+        if workerId in self._idle:
+            self._idle.remove( workerId )
+        busy = self._busy.pop( workerId, None )
+        if busy is not None:
+            commandId, crabArgs, started = busy
+            if started:
+                self._responses[ commandId ] = { 'status':"CrabCommandError", 'jobs':{} }
+                self._condition.notify_all()
+            else:
+                self._pending.insert( 0, ( commandId, crabArgs ) )
+        if not self._closed:
+            self._startWorker()
+        return p
+
+    ## Collect results from the workers and replace exited workers
+    def _collect(self):
+        while not self._closed or self._workers:
+            try:
+                kind, workerId, commandId, res = self._results.get( timeout = 1 )
+            except Empty:
+                self._checkWorkers()
+                continue
+            # workers which exited normally report it themselves, see 'exit'
+            self._checkWorkers( crashedOnly = True )
+            p = None
+            with self._condition:
+                if kind == 'start':
+                    if workerId in self._busy:
+                        self._busy[ workerId ] = self._busy[ workerId ][:2] + ( True, )
+                elif kind == 'done':
+                    # ignore results of commands which were already failed
+                    if self._busy.get( workerId, ( None, ) )[0] == commandId:
+                        self._busy.pop( workerId )
+                        self._responses[ commandId ] = res
+                    if workerId in self._workers and workerId not in self._busy \
+                       and workerId not in self._idle:
+                        self._idle.append( workerId )
+                    self._dispatch()
+                    self._condition.notify_all()
+                elif kind == 'exit':
+                    # the worker may already be removed by _checkWorkers
+                    p = self._removeWorker( workerId )
+            if p is not None:
+                p.join()
+
+    ## Replace crashed workers
+    #
+    # @param crashedOnly Only replace workers with a non zero exit code
+    def _checkWorkers(self, crashedOnly = False):
+        with self._condition:
+            for workerId, p in self._workers.items():
+                if not p.is_alive() and ( not crashedOnly or p.exitcode != 0 ):
+                    self._removeWorker( workerId )
+                    p.join()
+
+    ## Run a crab command in one of the workers and return result dict
+    #
+    # @param self The object pointer
+    # @param crabArgs A list of arguments for crab beginning with the command
+    def call(self, crabArgs):
+        with self._inFlight:
+            with self._condition:
+                commandId = next( self._commandIds )
+                self._pending.append( ( commandId, crabArgs ) )
+                self._dispatch()
+                while commandId not in self._responses:
+                    self._condition.wait( 1 )
+                return self._responses.pop( commandId )
+
+    ## Run several crab commands concurrently
+    #
+    # @param self The object pointer
+    # @param crabArgsList A list of crab argument lists
+    # @return A list with the result dicts in the order of crabArgsList
+    def map(self, crabArgsList):
+        pool = ThreadPool( max( 1, min( self.maxInFlight, len(crabArgsList) ) ) )
+        try:
+            return pool.map( self.call, crabArgsList )
+        finally:
+            pool.close()
+            pool.join()
+
+    ## Stop all workers
+    def close(self):
+        with self._condition:
+            self._closed = True
+            for commands in self._queues.values():
+                commands.put( None )
+        self._collector.join()
+
+## Job states counted in the job statistics of a CrabTask
+jobStateKeys = ['unsubmitted','idle','running','transferring','cooloff','failed','finished']
+
+## Function to map job numbers to the output files of a task on the dCache
+#
+# The file names are parsed once, so the lookup for each job is a dictionary
+# access instead of a scan over all files. As before, a file belongs to a job
+# if <name>_<jobnumber><fileXtension> appears anywhere in its path, the job
+# number is not continued by further digits.
+# @param name The task name, output files are named <name>_<jobnumber>
+# @param fileList A list of dCache file paths or a list of such lists as returned by gridFunctions.getdcachelist
+# @param fileXtension Only files whose name continues with this string after the job number are used [default: any]
+# @return A dictionary with the job number as string as key and the file path as value
+def dCacheJobIndex(name, fileList, fileXtension = ''):
+    pattern = re.compile( re.escape( name ) + r"_(\d+)(?!\d)" + re.escape( fileXtension ) )
+    index = {}
+    for entry in fileList:
+        paths = entry if isinstance( entry, list ) else [ entry ]
+        for path in paths:
+            for match in pattern.finditer( path ):
+                index.setdefault( match.group(1), path )
+    return index
+
+## Function to get the job number from the name of a crab log archive
+#
+# @param logArchName path to the compressed log file (cmsRun_<jobnumber>.log.tar.gz)
+# @return The job number as string
+def logArchJobNumber(logArchName):
+    return logArchName.split("/")[-1].split("_")[1].split(".")[0]
+
+## Metrics of the PerformanceReport in a FrameworkJobReport and their log keys
+fjrPerformanceMetrics = { 'TotalJobCPU' : 'cpuTime',
+                          'TotalJobTime' : 'wallTime',
+                          'PeakValueRss' : 'peakRss',
+                          'tstoragefile-read-totalMegabytes' : 'readMB',
+                          'tstoragefile-read-totalMsecs' : 'readTime' }
+
+## Function to parse a FrameworkJobReport from a file object
+#
+# The report is parsed incrementally and parsing stops as soon as all
+# fields are found.
+# @param xmlFile A file object of the FrameworkJobReport xml
+# @return a dictionary with the parsed fields, missing fields are not included
+def parseFrameworkJobReport(xmlFile):
+    log = {}
+    missing = set( fjrPerformanceMetrics.values() + ['readEvents', 'writtenEvents'] )
+    path = []
+    for event, elem in ET.iterparse( xmlFile, events = ( 'start', 'end' ) ):
+        if event == 'start':
+            path.append( elem.tag )
+            continue
+        path.pop()
+        parent = path[-1] if path else None
+        if elem.tag == 'EventsRead' and parent == 'InputFile' and 'readEvents' in missing:
+            log['readEvents'] = int( elem.text )
+            missing.discard( 'readEvents' )
+        elif elem.tag == 'TotalEvents' and parent == 'File':
+            log['writtenEvents'] = log.get( 'writtenEvents', 0 ) + int( elem.text )
+            missing.discard( 'writtenEvents' )
+        elif elem.tag == 'Metric' and elem.get( 'Name' ) in fjrPerformanceMetrics:
+            key = fjrPerformanceMetrics[ elem.get( 'Name' ) ]
+            if key in missing:
+                log[key] = float( elem.get( 'Value' ) )
+                missing.discard( key )
+        # top level elements are not needed anymore once they are complete
+        if len( path ) == 1:
+            elem.clear()
+        if not missing:
+            break
+    if 'readTime' in log:
+        log['readTime'] /= 1000.
+        if log['readTime'] > 0 and 'readMB' in log:
+            log['readThroughput'] = log['readMB'] / log['readTime']
+    return log
+
+## Function to read log info from log.tar.gz
+#
+# The archive is read as a stream and only the FrameworkJobReport is parsed.
+# Defined on module level, so it can be used in a process pool.
+# @param logArchName: path to the compressed log file
+# @return a dictionary with parsed info: readEvents and, if found in the
+# report, writtenEvents, cpuTime, wallTime (s), peakRss (MB), readMB,
+# readTime (s) and readThroughput (MB/s)
+def readLogArch(logArchName):
+    JobNumber = logArchJobNumber( logArchName )
+    log = {'readEvents' : 0}
+    try:
+        with tarfile.open( logArchName, "r|gz") as tar:
+            for member in tar:
+                if os.path.basename( member.name ) == 'FrameworkJobReport-%s.xml' % JobNumber:
+                    log.update( parseFrameworkJobReport( tar.extractfile( member ) ) )
+                    break
+    except:
+        print "Can not parse / read %s" % logArchName
+    return log
+
+## Function to read several log archives in a process pool
+#
+# @param logArchs List of paths to compressed log files
+# @param processes Number of processes used to read the log archives
+# @return a list of dictionaries as returned by readLogArch in the order of logArchs
+def readLogArchs(logArchs, processes = 4):
+    if processes > 1 and len( logArchs ) > 1:
+        pool = Pool( processes = min( processes, len( logArchs ) ) )
+        try:
+            return pool.map( readLogArch, logArchs )
+        finally:
+            pool.close()
+            pool.join()
+    return map( readLogArch, logArchs )
 
 ## Class for a single CrabRequest
 #
@@ -375,14 +850,19 @@ class CrabTask:
 
         self.finalFiles = []
         self.totalEvents = 0
+        # performance metrics of each job read from the job reports
+        self.jobMetrics = {}
         # crab config as a python object should only be used via .config
         self._crabConfig = None
         self._inDB = None
+        self._dbSearchResult = None
 
         self._globalTag_default = globalTag
         self._skimmer_version_default = skimmer_version
         self._json_file_default = json_file
 
+        self._resetJobStats()
+
         #start with first updates
         if initUpdate:
             self.update()
@@ -474,11 +954,11 @@ class CrabTask:
         if not self.inDB: return False
         else: return (self.dbSkim.isfinished and hasattr(self.dbSkim, 'files' ) )
 
-    def updateFromDB( self ):
-         # check if we have a db link
-        if self.dblink is None:
-            return False
-
+    ## Function to get the search criteria for the db entry of this task
+    #
+    # @param self: CrabTask The object pointer.
+    # @return A tuple of the skim and sample criteria
+    def dbSearchCriteria( self ):
         # fill search criteria for skim and samples
         skimCriteria = {}
         sampleCriteria = {}
@@ -486,12 +966,35 @@ class CrabTask:
         sampleCriteria[ "name" ] = self.name
         skimCriteria["skimmer_version"] = self.skimmer_version
         skimCriteria["skimmer_globaltag"] = self.globalTag
+        if self.isData:
+            skimCriteria["jsonfile"] = self.json_file
+        return skimCriteria, sampleCriteria
+
+    ## Function to set a search result obtained elsewhere, e.g. by a bulk search
+    #
+    # The result is used by updateFromDB instead of a new search until the
+    # next call of update finishes.
+    # @param self: CrabTask The object pointer.
+    # @param searchResult: The search result or an Aix3adbException
+    def setDBSearchResult( self, searchResult ):
+        self._dbSearchResult = searchResult
+
+    def updateFromDB( self ):
+         # check if we have a db link
+        if self.dblink is None:
+            return False
+
         try:
-            if self.isData:
-                skimCriteria["jsonfile"] = self.json_file
-                searchResult = self.dblink.searchDataSkimsAndSamples( skimCriteria, sampleCriteria )
-            else:
-                searchResult = self.dblink.searchMCSkimsAndSamples( skimCriteria, sampleCriteria )
+            searchResult = getattr( self, '_dbSearchResult', None )
+            if isinstance( searchResult, Exception ):
+                raise searchResult
+            if searchResult is None:
+                skimCriteria, sampleCriteria = self.dbSearchCriteria()
+                if self.isData:
+                    searchResult = self.dblink.searchDataSkimsAndSamples( skimCriteria, sampleCriteria )
+                else:
+                    searchResult = self.dblink.searchMCSkimsAndSamples( skimCriteria, sampleCriteria )
+            if not self.isData:
                 self.dbSkim = searchResult[0][0]
                 self.dbSample = searchResult[0][1]
                 self._inDB = True
@@ -517,10 +1020,13 @@ class CrabTask:
     ## Function to update Task in associated Jobs
     #
     # @param self: CrabTask The object pointer.
-    def update(self, updateDB = False):
+    # @type controller: CrabController
+    # @param controller: Controller used for the crab calls [default: new instance]
+    def update(self, updateDB = False, controller = None):
         #~ self.lock.acquire()
         self.isUpdating = True
-        controller =  CrabController()
+        if controller is None:
+            controller =  CrabController()
         self.state = "UPDATING"
         # check if we should drop this sample due to missing info
 
@@ -555,6 +1061,7 @@ class CrabTask:
             else:
                 self.state = "CREATED:%s" % self.dbSkim.owner
         self.isUpdating = False
+        self._dbSearchResult = None
         self.lastUpdate = datetime.datetime.now().strftime( "%Y-%m-%d_%H.%M.%S" )
         #~ self.lock.release()
 
@@ -579,39 +1086,67 @@ class CrabTask:
 
     def test_print(self):
         return self.uuid
+    ## Function to reset the incremental job statistics
+    #
+    # @param self: The object pointer.
+    def _resetJobStats(self):
+        self._jobStates = {}
+        self._stateCounts = dict( ( statekey, 0 ) for statekey in jobStateKeys )
+        self._finishedJobs = set()
+        self._dCacheIndex = ( None, {} )
+
     ## Function to update JobStatistics
     #
+    # Only jobs whose state changed since the last call update the state
+    # counters. The dCache file list is parsed once into an index of job
+    # numbers, which is reused as long as a list with the same files is passed.
     # @param self: The object pointer.
     # @param dCacheFilelist: A list of files on the dCache
     def updateJobStats(self,dCacheFileList = None):
-        jobKeys = sorted(self.jobs.keys())
-        try:
-            intJobkeys = [int(x) for x in jobKeys]
-        except:
-            print "error parsing job numers to int"
-
-        #maxjobnumber = max(intJobkeys)
-
-        stateDict = {'unsubmitted':0,'idle':0,'running':0,'transferring':0,'cooloff':0,'failed':0,'finished':0}
-        nComplete = 0
-
-        # loop through jobs
-        for key in jobKeys:
-            job = self.jobs[key]
-             #check if all completed files are on decache
-            for statekey in stateDict.keys():
-                if statekey in job['State']:
-                    stateDict[statekey]+=1
-                    # check if finished fails are found on dCache if dCacheFilelist is given
-                    if dCacheFileList is not None:
-                        outputFilename = "%s_%s"%( self.name, key)
-                        if 'finished' in statekey and any(outputFilename in s for s in dCacheFileList):
-                            nComplete +=1
-
-        for state in stateDict:
+        if not hasattr( self, '_jobStates' ):
+            self._resetJobStats()
+        # forget jobs which are not part of the task anymore
+        for key in [ key for key in self._jobStates if key not in self.jobs ]:
+            self._countJobState( key, None )
+        for key, job in self.jobs.iteritems():
+            self._countJobState( key, job['State'] )
+
+        for state in jobStateKeys:
             attrname = "n" + state.capitalize()
-            setattr(self, attrname, stateDict[state])
-        self.nComplete = nComplete
+            setattr(self, attrname, self._stateCounts[state])
+        # check if finished jobs are found on dCache if dCacheFilelist is given
+        if dCacheFileList is not None:
+            files = tuple( tuple( entry ) if isinstance( entry, list ) else entry for entry in dCacheFileList )
+            indexedFiles, index = self._dCacheIndex
+            if indexedFiles != files:
+                index = dCacheJobIndex( self.name, dCacheFileList )
+                self._dCacheIndex = ( files, index )
+            self.nComplete = sum( 1 for key in self._finishedJobs if key in index )
+        else:
+            self.nComplete = 0
+
+    ## Function to update the state counters for one job
+    #
+    # @param self: The object pointer.
+    # @param key: The job number
+    # @param state: The new crab state of the job, None if the job was removed
+    def _countJobState(self, key, state):
+        oldstate = self._jobStates.get( key )
+        if oldstate == state:
+            return
+        for statekey in jobStateKeys:
+            if oldstate is not None and statekey in oldstate:
+                self._stateCounts[statekey] -= 1
+            if state is not None and statekey in state:
+                self._stateCounts[statekey] += 1
+        if state is not None and 'finished' in state:
+            self._finishedJobs.add( key )
+        else:
+            self._finishedJobs.discard( key )
+        if state is None:
+            del self._jobStates[ key ]
+        else:
+            self._jobStates[ key ] = state
 
     ## Function to read log info from log.tar.gz
     #
@@ -619,29 +1154,42 @@ class CrabTask:
     # @param logArchName: path to the compressed log file
     # @return a dictionary with parsed info
     def readLogArch(self, logArchName):
-        JobNumber = logArchName.split("/")[-1].split("_")[1].split(".")[0]
-        log = {'readEvents' : 0}
-        with tarfile.open( logArchName, "r") as tar:
-            try:
-                JobXmlFile = tar.extractfile('FrameworkJobReport-%s.xml' % JobNumber)
-                root = ET.fromstring( JobXmlFile.read() )
-                for child in root:
-                    if child.tag == 'InputFile':
-                        for subchild in child:
-                            if subchild.tag == 'EventsRead':
-                                nEvents = int(subchild.text)
-                                log.update({'readEvents' : nEvents})
-                                break
-                        break
-            except:
-                print "Can not parse / read %s" % logArchName
-        return log
+        return readLogArch( logArchName )
 
-    ## Function to finalize task in TAPAS workflow
+    ## Function to get the log archives of the task retrieved with crab log
+    #
+    # @param self: The object pointer.
+    # @return a list of paths to the log archives
+    def logArchives(self):
+        crabFolder = CrabController()._prepareFoldername( self.name )
+        return glob.glob("%s/%s/results/*.log.tar.gz" % (self.crabConfig.General.workArea,crabFolder))
+
+    ## Function to read the performance metrics of all retrieved log archives
     #
-    # Get config files and submit samples
-    def finalizeTask(self , update = False, debug= False ):
+    # @param self: The object pointer.
+    # @param processes Number of processes used to read the log archives
+    # @return the updated dictionary jobMetrics with the job number as key
+    def readJobMetrics(self, processes = 4):
+        logArchs = self.logArchives()
+        for logArchName, log in zip( logArchs, readLogArchs( logArchs, processes ) ):
+            self.jobMetrics[ logArchJobNumber( logArchName ) ] = log
+        return self.jobMetrics
 
+    ## Function to finalize task in TAPAS workflow
+    #
+    # Get config files and submit samples. The sample is registered with
+    # CrabTaskManager.registerInDB, see CrabTaskManager.finalizeTasks.
+    # @param processes Number of processes used to read the log archives
+    def finalizeTask(self , update = False, debug= False, processes = 4 ):
+        failed = CrabTaskManager( [ self ] ).finalizeTasks( update = update, debug = debug, processes = processes )
+        if self.name in failed:
+            raise failed[ self.name ]
+
+    ## Function to collect the output files of a finished task and their events
+    #
+    # The results are stored in finalFiles, totalEvents and jobMetrics.
+    # @param processes Number of processes used to read the log archives
+    def collectFinalFiles(self, debug = False, processes = 4 ):
         outlfn = self.crabConfig.Data.outLFNDirBase.split('/store/user/')[1]
         if outlfn.endswith("/"): outlfn =outlfn[:-1]
         crab = CrabController()
@@ -656,35 +1204,34 @@ class CrabTask:
         p = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE, shell=True)#,shell=True,universal_newlines=True)
         (out,err) = p.communicate()
         #~ print out
-        crabFolder = crab._prepareFoldername( self.name )
-        #~ print crabFolder
-        logArchs = glob.glob("%s/%s/results/*.log.tar.gz" % (self.crabConfig.General.workArea,crabFolder))
+        logArchs = self.logArchives()
         finalFiles = []
         totalEvents = 0
-        #~ sys.exit()
-        for logArchName in logArchs:
-            JobNumber = logArchName.split("/")[-1].split("_")[1].split(".")[0]
-            #~ print logArchName
-            log = self.readLogArch( logArchName )
-            # check if file on dCache
-            dfile = []
-            for layer in dCacheFiles:
-                dfile += [s for s in layer if "%s_%s.pxlio" %( self.name, JobNumber ) in s ]
-            if len(dfile)  > 0 and log['readEvents'] > 0 :
-                finalFiles.append(  {'path':dfile[0], 'nevents':log['readEvents']} )
+        # map job numbers to the files on dCache in one pass
+        dCacheIndex = dCacheJobIndex( self.name, dCacheFiles, '.pxlio' )
+        # only logs of jobs with an output file on dCache are read
+        logArchs = [ logArchName for logArchName in logArchs
+                     if logArchJobNumber( logArchName ) in dCacheIndex ]
+        logs = readLogArchs( logArchs, processes )
+        self.jobMetrics = {}
+        for logArchName, log in zip( logArchs, logs ):
+            self.jobMetrics[ logArchJobNumber( logArchName ) ] = log
+            if log['readEvents'] > 0 :
+                dfile = dCacheIndex[ logArchJobNumber( logArchName ) ]
+                finalFiles.append(  {'path':dfile, 'nevents':log['readEvents']} )
                 totalEvents += log['readEvents']
         self.finalFiles = finalFiles
         self.totalEvents = totalEvents
-        if self.isData:
-            self.addData2db( True )
-        else:
-            self.addMC2db( True )
 
+    ## Function to mark a task as final after it was registered in the db
+    def markFinal(self):
         with open('finalSample','a') as outfile:
             outfile.write("%s:%s\n" % ( self.name,  self.crabConfig.Data.inputDataset))
         self.state = "FINAL"
 
     def addData2db( self, update=False):
+        # a prefetched search result is outdated once we write to the db
+        self._dbSearchResult = None
         crab = crabFunctions.CrabController()
         # try to get sample db entry and create it otherwise
         newInDB = False
@@ -720,40 +1267,15 @@ class CrabTask:
 #~ update
 
     def addMC2db( self, update = False ):
-        crab = CrabController()
-        generators = {}
-        generators.update({ 'MG':'madgraph' })
-        generators.update({ 'PH':'powheg' })
-        generators.update({ 'HW':'herwig6' })
-        generators.update({ 'HP':'herwigpp' })
-        generators.update({ 'HW':'herwig' })
-        generators.update({ 'SP':'sherpa' })
-        generators.update({ 'MC':'mcatnlo' })
-        generators.update({ 'AG':'alpgen' })
-        generators.update({ 'CA':'calchep' })
-        generators.update({ 'CO':'comphep'  })
-        generators.update({ 'P6':'pythia6' })
-        generators.update({ 'P8':'pythia8' })
-        generators.update({ 'PY':'pythia8' })
-        newInDB = False
-            # get infos from McM
-        mcmutil = dbutilscms.McMUtilities()
-        mcmutil.readURL( self.crabConfig.Data.inputDataset )
+        # a prefetched search result is outdated once we write to the db
+        self._dbSearchResult = None
         # try to get sample db entry and create it otherwise
         try:
             self.dbSample = self.dblink.getMCSample( self.name )
+            newInDB = False
         except Aix3adbException:
-            self.dbSample = aix3adb.MCSample()
+            self.dbSample = self.newMCSample()
             newInDB = True
-            self.dbSample.name = self.name
-            self.dbSample.generator = generators[ self.name.split("_")[-1] ]
-            self.dbSample.crosssection = str(mcmutil.getCrossSection())
-            self.dbSample.crosssection_reference = 'McM'
-            self.dbSample.filterefficiency = mcmutil.getGenInfo('filter_efficiency')
-            self.dbSample.filterefficiency_reference = 'McM'
-            self.dbSample.kfactor = 1.
-            self.dbSample.kfactor_reference = "None"
-            self.dbSample.energy = mcmutil.getEnergy()
 
         if newInDB:
             self.dbSample = self.dblink.insertMCSample( self.dbSample )
@@ -772,9 +1294,70 @@ class CrabTask:
         else:
             self.dblink.insertMCSkim( self.dbSkim )
 
+    ## Function to create a new db sample for a MC task with infos from McM
+    #
+    # @param self: CrabTask The object pointer.
+    # @return A new aix3adb.MCSample object
+    def newMCSample( self ):
+        generators = {}
+        generators.update({ 'MG':'madgraph' })
+        generators.update({ 'PH':'powheg' })
+        generators.update({ 'HW':'herwig6' })
+        generators.update({ 'HP':'herwigpp' })
+        generators.update({ 'HW':'herwig' })
+        generators.update({ 'SP':'sherpa' })
+        generators.update({ 'MC':'mcatnlo' })
+        generators.update({ 'AG':'alpgen' })
+        generators.update({ 'CA':'calchep' })
+        generators.update({ 'CO':'comphep'  })
+        generators.update({ 'P6':'pythia6' })
+        generators.update({ 'P8':'pythia8' })
+        generators.update({ 'PY':'pythia8' })
+        # get infos from McM
+        mcmutil = dbutilscms.McMUtilities( dbutilscms.defaultMcMCache() )
+        mcmutil.readURL( self.crabConfig.Data.inputDataset )
+        dbSample = aix3adb.MCSample()
+        dbSample.name = self.name
+        dbSample.generator = generators[ self.name.split("_")[-1] ]
+        dbSample.crosssection = str(mcmutil.getCrossSection())
+        dbSample.crosssection_reference = 'McM'
+        dbSample.filterefficiency = mcmutil.getGenInfo('filter_efficiency')
+        dbSample.filterefficiency_reference = 'McM'
+        dbSample.kfactor = 1.
+        dbSample.kfactor_reference = "None"
+        dbSample.energy = mcmutil.getEnergy()
+        return dbSample
+
+    ## Function to prepare the db sample and skim of this task without db calls
+    #
+    # The fields are filled as in addMC2db and addData2db. The objects can
+    # be written with aix3adb.upsertMCSamplesAndSkims, which also sets the
+    # sampleid of the skim for new samples.
+    # @param self: CrabTask The object pointer.
+    # @param dbSample: The sample entry in the db, None if it does not exist yet
+    # @param dbSkim: The skim entry to update, None to create a new skim
+    # @return A tuple of sample and skim
+    def prepareDBEntries( self, dbSample = None, dbSkim = None ):
+        self._dbSearchResult = None
+        if self.isData:
+            if dbSample is None:
+                dbSample = aix3adb.DataSample( )
+                dbSample.name = self.name
+            dbSample.energy = 13
+        elif dbSample is None:
+            dbSample = self.newMCSample()
+        self.dbSample = dbSample
+        if dbSkim is None:
+            dbSkim = aix3adb.DataSkim() if self.isData else aix3adb.MCSkim()
+        self.dbSkim = dbSkim
+        self.fillCommonSkimFields( )
+        if self.isData:
+            self.dbSkim.jsonfile = self.crabConfig.Data.lumiMask.split("/")[-1]
+        return self.dbSample, self.dbSkim
+
     def fillCommonSkimFields( self ):
         # create relation to dbsample object
-        self.dbSkim.sampleid = self.dbSample.id
+        self.dbSkim.sampleid = getattr( self.dbSample, 'id', None )
         self.dbSkim.datasetpath = self.crabConfig.Data.inputDataset
         outlfn = self.crabConfig.Data.outLFNDirBase.split('/store/user/')[1]
         crab = CrabController()
@@ -793,6 +1376,171 @@ class CrabTask:
         self.dbSkim.skimmer_globaltag = [p.replace("globalTag=","").strip() for p in self.crabConfig.JobType.pyCfgParams if "globalTag" in p][0]
         self.dbSkim.nevents = str( self.totalEvents )
 
+## Class to manage a collection of CrabTask objects
+#
+# This class updates many CrabTask objects concurrently in a bounded pool of
+# threads which share one CrabController. Combined with a CrabWorkerPool
+# in the controller, a full sweep takes about as long as the slowest task.
+class CrabTaskManager:
+
+    ## The object constructor
+    #
+    # @type self: CrabTaskManager
+    # @param self: The object pointer.
+    # @type tasks: List of CrabTask objects
+    # @param tasks: (Optional) List of CrabTasks to manage
+    # @type controller: CrabController
+    # @param controller: Controller shared by all updates [default: new instance]
+    # @param processes: Maximum number of simultaneous task updates
+    def __init__(self, tasks = None, controller = None, processes = 8):
+        self.tasks = list(tasks) if tasks is not None else []
+        self.controller = controller if controller is not None else CrabController()
+        self.processes = processes
+        self.stats = TaskStats()
+        self.logger = logging.getLogger("CrabTaskManager")
+
+    ## Add a CrabTask to the collection
+    #
+    # @param self: The object pointer.
+    # @param task: The CrabTask object
+    def addTask(self, task):
+        self.tasks.append(task)
+
+    def _updateTask(self, args):
+        task, updateDB = args
+        try:
+            task.update( updateDB = updateDB, controller = self.controller )
+        except Exception as e:
+            self.logger.error( "Update of task %s failed: %s" % ( task.name, str(e) ) )
+            task.isUpdating = False
+        return task
+
+    ## Search the db entries of all tasks with few bulk requests
+    #
+    # The results are set on the tasks, so their next update does not
+    # search the database again. Tasks without a dblink are skipped.
+    # @param self: The object pointer.
+    def prefetchFromDB(self):
+        byLink = {}
+        for task in self.tasks:
+            if task.dblink is None:
+                continue
+            try:
+                byLink.setdefault( id( task.dblink ), ( task.dblink, [], [] ) )[ 2 if task.isData else 1 ].append( task )
+            except Exception as e:
+                self.logger.error( "Could not prepare db search for task %s: %s" % ( task.name, str(e) ) )
+        for dblink, mcTasks, dataTasks in byLink.values():
+            for tasks, search in ( ( mcTasks, dblink.searchMCSkimsAndSamplesMultiple ),
+                                   ( dataTasks, dblink.searchDataSkimsAndSamplesMultiple ) ):
+                if not tasks:
+                    continue
+                try:
+                    results = search( [ task.dbSearchCriteria() for task in tasks ] )
+                except Exception as e:
+                    self.logger.error( "Bulk db search failed: %s" % str(e) )
+                    continue
+                for task, result in zip( tasks, results ):
+                    task.setDBSearchResult( result )
+
+    ## Finalize all tasks and register them in the db with few bulk requests
+    #
+    # Only tasks which were registered successfully become final.
+    # @param self: The object pointer.
+    # @param update: Unused, the latest skim of existing samples is always updated as in CrabTask.finalizeTask
+    # @param processes Number of processes used to read the log archives
+    # @return A dictionary with the task name as key and the error as value for tasks which failed
+    def finalizeTasks(self, update = False, debug = False, processes = 4):
+        failed = {}
+        tasks = []
+        for task in self.tasks:
+            if task.dblink is None:
+                failed[ task.name ] = Aix3adbException( "No db link for task %s" % task.name )
+                continue
+            try:
+                task.collectFinalFiles( debug = debug, processes = processes )
+            except Exception as e:
+                self.logger.error( "Could not collect the output of task %s: %s" % ( task.name, str( e ) ) )
+                failed[ task.name ] = e
+                continue
+            tasks.append( task )
+        failed.update( self.registerInDB( update = True, tasks = tasks ) )
+        for task in tasks:
+            if task.name not in failed:
+                task.markFinal()
+        return failed
+
+    ## Create or update the db entries of all tasks with few bulk requests
+    #
+    # @param self: The object pointer.
+    # @param update: Update the latest skim of existing samples instead of adding a new skim
+    # @param tasks: The tasks to register [default: all tasks]
+    # @return A dictionary with the task name as key and the error as value for tasks which failed
+    def registerInDB(self, update = False, tasks = None):
+        failed = {}
+        groups = {}
+        for task in ( self.tasks if tasks is None else tasks ):
+            if task.dblink is None:
+                continue
+            groups.setdefault( ( id( task.dblink ), task.isData ), ( task.dblink, [] ) )[1].append( task )
+        for ( linkid, isData ), ( dblink, tasks ) in groups.items():
+            names = [ task.name for task in tasks ]
+            if isData:
+                samples = dblink.getDataSampleMultiple( names )
+                getLatest = dblink.getDataLatestSkimAndSampleBySampleMultiple
+                upsert = dblink.upsertDataSamplesAndSkims
+            else:
+                samples = dblink.getMCSampleMultiple( names )
+                getLatest = dblink.getMCLatestSkimAndSampleBySampleMultiple
+                upsert = dblink.upsertMCSamplesAndSkims
+                # resolve McM infos of new samples concurrently, they are cached
+                dbutilscms.getGenInfoMultiple( [ task.crabConfig.Data.inputDataset for task in tasks
+                                                 if isinstance( samples[ task.name ], Exception ) ] )
+            latest = {}
+            if update:
+                latest = getLatest( [ name for name in names if not isinstance( samples[name], Exception ) ] )
+            pairs = []
+            preparedTasks = []
+            for task in tasks:
+                sample = samples[ task.name ]
+                skim = None
+                if task.name in latest and not isinstance( latest[ task.name ], Exception ):
+                    skim, sample = latest[ task.name ]
+                try:
+                    pairs.append( task.prepareDBEntries( None if isinstance( sample, Exception ) else sample, skim ) )
+                    preparedTasks.append( task )
+                except Exception as e:
+                    failed[ task.name ] = e
+            for task, result in zip( preparedTasks, upsert( pairs ) ):
+                if isinstance( result, Exception ):
+                    failed[ task.name ] = result
+                else:
+                    task.dbSample, task.dbSkim = result
+                    task._inDB = True
+        for name, error in failed.items():
+            self.logger.error( "Could not register task %s in db: %s" % ( name, str( error ) ) )
+        return failed
+
+    ## Update all tasks concurrently and aggregate their statistics
+    #
+    # @param self: The object pointer.
+    # @param updateDB: Passed to CrabTask.update
+    # @param prefetchDB: Search the db entries of all tasks in bulk before the update
+    # @return TaskStats object for all tasks
+    def update(self, updateDB = False, prefetchDB = True):
+        # read the crab configs one after another before the threads start
+        for task in self.tasks:
+            task.crabConfig
+        if prefetchDB:
+            self.prefetchFromDB()
+        if self.tasks:
+            pool = ThreadPool( max( 1, min( self.processes, len( self.tasks ) ) ) )
+            try:
+                pool.map( self._updateTask, [ ( task, updateDB ) for task in self.tasks ] )
+            finally:
+                pool.close()
+                pool.join()
+        self.stats.updateStats( self.tasks )
+        return self.stats
 
 ## Class holds job statistics for several Crab tasks
 #
@@ -845,3 +1593,171 @@ class TaskStats:
         self.nFailed    = 0
         self.nFinished    = 0
         self.nComplete    = 0
+
+## Class to analyse the performance of crab jobs
+#
+# This class aggregates the metrics read from the FrameworkJobReports of
+# one or several tasks (see readLogArch). It calculates distributions of
+# each metric, lists outlier jobs and breaks the metrics down per site.
+# The report can be printed or written to a json file.
+class JobPerformanceReport:
+    ## Metrics included in the report
+    metrics = [ 'wallTime', 'cpuTime', 'cpuEfficiency', 'peakRss',
+                'readEvents', 'eventRate', 'readMB', 'readThroughput' ]
+    ## Metrics for which low values mark an outlier, high values otherwise
+    lowOutlierMetrics = [ 'cpuEfficiency', 'eventRate', 'readThroughput' ]
+    ## Metrics checked for outliers
+    outlierMetrics = [ 'wallTime', 'peakRss', 'cpuEfficiency', 'eventRate', 'readThroughput' ]
+
+    ## The object constructor
+    #
+    # @type self: JobPerformanceReport
+    # @param self: The object pointer.
+    # @type tasks: List of CrabTask objects
+    # @param tasks: (Optional) List of CrabTasks to include
+    # @param outlierFactor: Jobs which differ by more than this factor from the median are outliers
+    def __init__(self, tasks = None, outlierFactor = 3.):
+        self.outlierFactor = outlierFactor
+        self.jobs = []
+        for task in tasks or []:
+            self.addTask( task )
+
+    ## Add the jobs of a task to the report
+    #
+    # The metrics are taken from task.jobMetrics, which is filled from the
+    # log archives if it is empty.
+    # @param self: The object pointer.
+    # @param task: The CrabTask object
+    # @param processes Number of processes used to read the log archives
+    def addTask(self, task, processes = 4):
+        jobMetrics = getattr( task, 'jobMetrics', None )
+        if not jobMetrics:
+            task.jobMetrics = {}
+            jobMetrics = task.readJobMetrics( processes )
+        for jobNumber, log in jobMetrics.iteritems():
+            siteHistory = task.jobs.get( jobNumber, {} ).get( 'SiteHistory' )
+            site = siteHistory[-1] if siteHistory else 'unknown'
+            self.addJob( task.name, jobNumber, site, log )
+
+    ## Add the metrics of a single job to the report
+    #
+    # @param self: The object pointer.
+    # @param taskname: Name of the task the job belongs to
+    # @param jobNumber: The job number
+    # @param site: The site the job ran at
+    # @param log: Dictionary with metrics as returned by readLogArch
+    def addJob(self, taskname, jobNumber, site, log):
+        job = dict( log )
+        if job.get( 'wallTime' ):
+            if 'cpuTime' in job:
+                job['cpuEfficiency'] = job['cpuTime'] / job['wallTime']
+            if job.get( 'readEvents' ):
+                job['eventRate'] = job['readEvents'] / job['wallTime']
+        job.update( { 'task' : taskname, 'job' : str( jobNumber ), 'site' : site } )
+        self.jobs.append( job )
+
+    ## Calculate the distribution of a list of values
+    #
+    # @param values: List of numbers
+    # @return Dictionary with n, mean, median, p90, min and max
+    @staticmethod
+    def distribution(values):
+        if not values:
+            return { 'n' : 0 }
+        values = sorted( values )
+        n = len( values )
+        return { 'n' : n,
+                 'mean' : sum( values ) / float( n ),
+                 'median' : values[ n // 2 ] if n % 2 else 0.5 * ( values[ n // 2 - 1 ] + values[ n // 2 ] ),
+                 'p90' : values[ min( n - 1, int( 0.9 * n ) ) ],
+                 'min' : values[0],
+                 'max' : values[-1] }
+
+    ## Calculate the distributions of all metrics for a list of jobs
+    #
+    # @param self: The object pointer.
+    # @param jobs: List of job dictionaries
+    # @return Dictionary with the metric as key and its distribution as value
+    def distributions(self, jobs):
+        return dict( ( metric, self.distribution( [ job[metric] for job in jobs if metric in job ] ) )
+                     for metric in self.metrics )
+
+    ## Find jobs with outlying metrics
+    #
+    # @param self: The object pointer.
+    # @param overall: (Optional) Distributions of all jobs as returned by distributions
+    # @return List of dictionaries with task, job, site, metric, value and median
+    def outliers(self, overall = None):
+        if overall is None:
+            overall = self.distributions( self.jobs )
+        outliers = []
+        for metric in self.outlierMetrics:
+            median = overall[ metric ].get( 'median' )
+            if not median:
+                continue
+            for job in self.jobs:
+                if metric not in job:
+                    continue
+                if metric in self.lowOutlierMetrics:
+                    isOutlier = job[metric] * self.outlierFactor < median
+                else:
+                    isOutlier = job[metric] > median * self.outlierFactor
+                if isOutlier:
+                    outliers.append( { 'task' : job['task'], 'job' : job['job'], 'site' : job['site'],
+                                       'metric' : metric, 'value' : job[metric], 'median' : median } )
+        return outliers
+
+    ## Create the full report
+    #
+    # @param self: The object pointer.
+    # @return Dictionary with the entries njobs, overall, sites and outliers
+    def summary(self):
+        overall = self.distributions( self.jobs )
+        sites = {}
+        for job in self.jobs:
+            sites.setdefault( job['site'], [] ).append( job )
+        return { 'njobs' : len( self.jobs ),
+                 'overall' : overall,
+                 'sites' : dict( ( site, self.distributions( jobs ) ) for site, jobs in sites.iteritems() ),
+                 'outliers' : self.outliers( overall ) }
+
+    ## Write the report to a json file
+    #
+    # @param self: The object pointer.
+    # @param filename: Path of the output file
+    # @param withJobs: Include the metrics of every single job
+    def writeJson(self, filename, withJobs = False):
+        report = self.summary()
+        if withJobs:
+            report['jobs'] = self.jobs
+        with open( filename, 'w' ) as outfile:
+            json.dump( report, outfile, indent = 2, sort_keys = True )
+
+    ## Print the report to the terminal
+    #
+    # @param self: The object pointer.
+    # @param maxOutliers: Maximum number of outliers to print
+    def printReport(self, maxOutliers = 20):
+        report = self.summary()
+        row = "%-16s %8s %10s %10s %10s %10s %10s"
+        print "Performance of %d jobs" % report['njobs']
+        print row % ( 'metric', 'n', 'mean', 'median', 'p90', 'min', 'max' )
+        for metric in self.metrics:
+            dist = report['overall'][metric]
+            if dist['n']:
+                print row % ( metric, dist['n'], '%.4g' % dist['mean'], '%.4g' % dist['median'],
+                              '%.4g' % dist['p90'], '%.4g' % dist['min'], '%.4g' % dist['max'] )
+        print
+        row = "%-24s %6s %12s %12s %12s %14s"
+        print row % ( 'site', 'njobs', 'wallTime', 'cpuEff', 'peakRss', 'readMB/s' )
+        for site, dists in sorted( report['sites'].items(), key = lambda item: -item[1]['wallTime']['n'] ):
+            medians = [ '%.4g' % dists[metric]['median'] if dists[metric]['n'] else '-'
+                        for metric in ( 'wallTime', 'cpuEfficiency', 'peakRss', 'readThroughput' ) ]
+            njobs = max( dist['n'] for dist in dists.values() )
+            print row % tuple( [ site, njobs ] + medians )
+        if report['outliers']:
+            print
+            print "Outliers (%d, factor %g from median):" % ( len( report['outliers'] ), self.outlierFactor )
+            for outlier in report['outliers'][:maxOutliers]:
+                print "  %s job %s at %s: %s %.4g (median %.4g)" % ( outlier['task'], outlier['job'],
+                    outlier['site'], outlier['metric'], outlier['value'], outlier['median'] )
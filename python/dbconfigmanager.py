@@ -26,6 +26,10 @@
 # update_succesful = cfgmgr.update_config(["blub"])
 # update_succesful = cfgmgr.update_config(["blub"], "../cfg/xs/xsv300.cfg")
 #
+# Show the changes an update would make without writing a new revision
+# cfgmgr.update_config(["blub"], dry_run=True)
+# changes = cfgmgr.diff(["blub"])
+#
 # Instead of frequently querying the database, one can use auto_update. This
 # will only perform a query, if the latest revision is older than the second
 # argument (24 hours in this example).
@@ -33,10 +37,16 @@
 #
 # Retrieving the read python config
 # cfgmgr.get_config()
+#
+# To resolve the values offline from a local snapshot of the database (see
+# aix3adb.py snapshot), pass a cached database object
+# cfgmgr = dbconfigmanager.DBConfigManager("../cfg/xs/",
+#              aix3adb.aix3adbCached("aix3adb-cache.db", offline=True))
 
 
 import sys
 import os
+import StringIO
 
 import logging
 import ConfigParser
@@ -59,7 +69,9 @@ class DBConfigManager:
     #
     # @param self The object pointer.
     # @param directory_path The path to the working directory.
-    def __init__(self, directory_path="../cfg/xs/"):
+    # @param dblink Database object to use, e.g. an aix3adb.aix3adbCached
+    # object to work offline from a snapshot. Default is a new aix3adb object.
+    def __init__(self, directory_path="../cfg/xs/", dblink=None):
         # set config file directory
         ## @var directory
         # Working directory of the config manager
@@ -69,7 +81,10 @@ class DBConfigManager:
         self.config = ConfigParser.SafeConfigParser()
         ## @var aix3adb
         # Aix3adb database object
-        self.aix3adb = aix3adb.aix3adb()
+        self.aix3adb = dblink if dblink is not None else aix3adb.aix3adb()
+        ## @var changes
+        # Changes found by the last update, list of (sample, field, old, new)
+        self.changes = []
 
     ## Set the working directory of the DBConfigManager
     #
@@ -91,7 +106,7 @@ class DBConfigManager:
 
         # get all _files_ in directory
         files = []
-         for (dirpath, dirnames, filenames) in os.walk(self.directory):
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
             files.extend(filenames)
             break
 
@@ -121,6 +136,48 @@ class DBConfigManager:
         return self.directory + "/" + self.latest_file()
 
     
+    ## Fetches the database entries of all samples in bulk
+    #
+    # Samples with an id in the config are fetched by skim id, all others
+    # by their latest skim. The entries are requested with a few batched
+    # calls instead of one call per sample.
+    #
+    # @param self The object pointer
+    # @param sample_list List of samples to fetch
+    # @return Dictionary with the sample as key and a (skim, sample) tuple or
+    # an aix3adb.Aix3adbException as value
+    def fetch_samples(self, sample_list):
+        by_skimid = {}
+        by_name = []
+        for sample in sample_list:
+            if self.config.has_option(sample, "id"):
+                by_skimid[sample] = self.config.getint(sample, "id")
+            else:
+                by_name.append(sample)
+
+        entries = {}
+        if by_name:
+            entries.update(self.aix3adb.getMCLatestSkimAndSampleBySampleMultiple(by_name))
+        if by_skimid:
+            results = self.aix3adb.getMCSkimAndSampleBySkimMultiple(by_skimid.values())
+            for sample, skimid in by_skimid.items():
+                entry = results[skimid]
+                # same check as aix3adb.getMCSkimAndSample
+                if not isinstance(entry, Exception) and entry[1].name != sample:
+                    raise Exception("Skimid " + str(skimid) + " and sample name " + str(sample) + " do not match.")
+                entries[sample] = entry
+        return entries
+
+    ## Records a change of a sample field and logs it
+    #
+    # @param self The object pointer
+    # @param sample Sample which is changed
+    # @param field Name of the changed field
+    # @param old Old value, None for a new sample
+    # @param new New value, None for a removed sample
+    def record_change(self, sample, field, old, new):
+        self.changes.append((sample, field, old, new))
+
     ## Compares sample values with database entry
     #
     # Returns true if sample values are up to date, else false Returns the
@@ -128,21 +185,31 @@ class DBConfigManager:
     #
     # @param self The object pointer
     # @param sample Sample which is being compared
+    # @param entry Database entry of the sample as returned by fetch_samples.
+    # Optional, fetched from the database if not given.
     # @return True if sample is up to date, else False
-    def compare_sample(self, sample):
+    def compare_sample(self, sample, entry=None):
         try:
-            skimid = self.config.getint(sample, "id") if self.config.has_option(sample, "id") else None
-            db_skim, db_sample = self.aix3adb.getMCSkimAndSample(skimid, sample)
+            if entry is None:
+                skimid = self.config.getint(sample, "id") if self.config.has_option(sample, "id") else None
+                entry = self.aix3adb.getMCSkimAndSample(skimid, sample)
+            if isinstance(entry, Exception):
+                raise entry
+            db_skim, db_sample = entry
         except aix3adb.Aix3adbException:
             log.error("Sample '" + sample + "' could not be found in the database. It has been removed from the config.")
             # if sample is not in the database and not in the config,
             # the config is considered up to date
-            return not self.config.remove_section(sample)
+            removed = self.config.remove_section(sample)
+            if removed:
+                self.record_change(sample, "section", sample, None)
+            return not removed
 
         up_to_date = True
         # update section
         if not self.config.has_section(sample):
             log.info("Created new section for sample '" + sample + "'.")
+            self.record_change(sample, "section", None, sample)
             up_to_date = False
             self.config.add_section(sample)
             self.config.set(sample, "nevents", "0")
@@ -158,6 +225,7 @@ class DBConfigManager:
                      + " [Crosssection] Old " + str(crosssection)
                      + " -- >>NEW<< " + str(db_crosssection))
             up_to_date = False
+            self.record_change(sample, "crosssection", crosssection, db_crosssection)
             self.config.set(sample, "crosssection", str(db_crosssection))
 
         # update weight
@@ -169,6 +237,7 @@ class DBConfigManager:
                      + " [Weight] Old " + str(weight)
                      + " -- >>NEW<< " + str(db_weight))
             up_to_date = False
+            self.record_change(sample, "weight", weight, db_weight)
             self.config.set(sample, "weight", str(db_weight))
 
         # update nevents
@@ -179,6 +248,7 @@ class DBConfigManager:
                      " [NEvents] Old " + str(nevents)
                      + " -- >>NEW<< " + str(db_nevents))
             up_to_date = False
+            self.record_change(sample, "nevents", nevents, db_nevents)
             self.config.set(sample, "nevents", str(db_nevents))
 
         return up_to_date
@@ -231,17 +301,32 @@ class DBConfigManager:
     # @param sample_list List of samples to update in the config file
     # @param config_file Config file to update. Default is the latest revision
     # of config files
+    # @param dry_run Only report the changes in self.changes, the config and
+    # the config files are left unchanged
     # @return True if the update is succesful or unnecessary, else False.
-    def update_config(self, sample_list, config_file=None):
+    def update_config(self, sample_list, config_file=None, dry_run=False):
         # read config if one is given
         if not config_file is None:
             self.read_config(config_file)
 
-        # loop over sample list and update the values
+        if dry_run:
+            original_config = self.config
+            self.config = copy_config(self.config)
+
+        # fetch all database entries at once and update the values
         log.info("Updating config...")
+        self.changes = []
+        entries = self.fetch_samples(sample_list)
         up_to_date = True
         for sample in sample_list:
-            up_to_date = self.compare_sample(sample) and up_to_date
+            up_to_date = self.compare_sample(sample, entries[sample]) and up_to_date
+
+        if dry_run:
+            self.config = original_config
+            for sample, field, old, new in self.changes:
+                log.info("[dry run] " + sample + " [" + field + "] " + str(old) + " -> " + str(new))
+            log.info("Dry run, " + str(len(self.changes)) + " changes not written.")
+            return True
 
         # write revision if necessary
         if up_to_date:
@@ -263,6 +348,18 @@ class DBConfigManager:
             return True
 
 
+    ## Returns the changes an update of config_file would make
+    #
+    # @param self The object pointer
+    # @param sample_list List of samples to compare
+    # @param config_file Config file to compare. Default is the loaded config
+    # @return List of changes (sample, field, old value, new value). Old is
+    # None for new samples, new is None for removed samples.
+    def diff(self, sample_list, config_file=None):
+        self.update_config(sample_list, config_file, dry_run=True)
+        return self.changes
+
+
     ## Update the latest revision of config files if older than age_in_hours
     #
     # Calls update_config(sample_list) if the timestamp is older than
@@ -287,6 +384,18 @@ class DBConfigManager:
 
         return self.update_config(sample_list)
 
+## Returns an independent copy of a config object
+#
+# @param config ConfigParser object to copy
+# @return New SafeConfigParser object with the same content
+def copy_config(config):
+    buf = StringIO.StringIO()
+    config.write(buf)
+    buf.seek(0)
+    copy = ConfigParser.SafeConfigParser()
+    copy.readfp(buf)
+    return copy
+
 ## main() method for testing purposes
 def main():
     logging.basicConfig(level=logging.DEBUG)
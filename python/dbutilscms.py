@@ -9,27 +9,173 @@
 import urllib2
 import json
 import logging
+import os
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger( 'dbutilscms' )
 
+## Persistent cache of McM json responses
+#
+# Responses are stored as one json file per dataset in the cache directory
+# and are reused until they are older than the ttl. Within one process,
+# concurrent requests for the same dataset wait for a single download.
+class McMCache():
+    ## The constructor.
+    # @param self: The object pointer.
+    # @param directory: Directory for the cached responses [default: ~/.dbutilscms/mcm]
+    # @param ttl: Time in seconds after which a cached response is refreshed
+    def __init__(self, directory = None, ttl = 24 * 3600):
+        if directory is None:
+            directory = os.path.join( os.path.expanduser( "~" ), ".dbutilscms", "mcm" )
+        self.directory = directory
+        self.ttl = ttl
+        self._memory = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, dataset):
+        return os.path.join( self.directory, hashlib.sha1( dataset ).hexdigest() + ".json" )
+
+    ## Get a cached response
+    # @param self: The object pointer.
+    # @param dataset: String containing the dataset name
+    # @return The json dictionary or None if it is not cached or expired
+    def get(self, dataset):
+        entry = self._memory.get( dataset )
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        filename = self._filename( dataset )
+        try:
+            mtime = os.path.getmtime( filename )
+            if time.time() - mtime >= self.ttl:
+                return None
+            with open( filename ) as cachefile:
+                data = json.load( cachefile )
+        except ( OSError, IOError, ValueError ):
+            return None
+        self._memory[ dataset ] = ( mtime, data )
+        return data
+
+    ## Store a response in the cache
+    # @param self: The object pointer.
+    # @param dataset: String containing the dataset name
+    # @param data: The json dictionary
+    def put(self, dataset, data):
+        self._memory[ dataset ] = ( time.time(), data )
+        try:
+            if not os.path.isdir( self.directory ):
+                os.makedirs( self.directory )
+            filename = self._filename( dataset )
+            tmpname = "%s.%d.%d" % ( filename, os.getpid(), threading.current_thread().ident )
+            with open( tmpname, "w" ) as cachefile:
+                json.dump( data, cachefile )
+            os.rename( tmpname, filename )
+        except ( OSError, IOError ):
+            log.warning( "Could not write McM cache for " + dataset )
+
+    ## Remove all cached responses
+    # @param self: The object pointer.
+    def clear(self):
+        self._memory = {}
+        if os.path.isdir( self.directory ):
+            for filename in os.listdir( self.directory ):
+                if filename.endswith( ".json" ):
+                    os.remove( os.path.join( self.directory, filename ) )
+
+    ## Get a response from the cache or download it
+    # @param self: The object pointer.
+    # @param url: The request url
+    # @param dataset: String containing the dataset name, used as cache key
+    # @return The json dictionary or None if the response is no valid json
+    def fetch(self, url, dataset):
+        with self._lock:
+            lock = self._locks.setdefault( dataset, threading.Lock() )
+        with lock:
+            data = self.get( dataset )
+            if data is None:
+                data = readMcMJSON( urllib2.urlopen( url ) )
+                if data is not None:
+                    self.put( dataset, data )
+            return data
+
+_defaultMcMCache = None
+## Get the McMCache instance shared in this process
+# @return The default McMCache object
+def defaultMcMCache():
+    global _defaultMcMCache
+    if _defaultMcMCache is None:
+        _defaultMcMCache = McMCache()
+    return _defaultMcMCache
+
+def readMcMJSON(json_string):
+    try:
+        return json.load(json_string)
+    except ValueError:
+        log.error("Could not read JSON at request URL.")
+        return None
+
+## Resolve generator information for many datasets concurrently
+#
+# All lookups share one McMCache, so parents common to several datasets
+# are requested only once.
+# @param datasets: List of dataset names
+# @param keys: Generator parameters to resolve
+# @param processes: Number of simultaneous requests
+# @param cache: The McMCache to use [default: defaultMcMCache()]
+# @return A dictionary with the dataset as key and a dictionary key -> value as value.
+# The values are None if they could not be resolved.
+def getGenInfoMultiple(datasets, keys = ("cross_section", "filter_efficiency"), processes = 8, cache = None):
+    if cache is None:
+        cache = defaultMcMCache()
+    def resolve( dataset ):
+        # a failing dataset must not abort the lookup of all others
+        try:
+            mcmutil = McMUtilities( cache )
+            mcmutil.readURL( dataset )
+            if mcmutil.mcm_json is None:
+                return dataset, dict( ( key, None ) for key in keys )
+            return dataset, dict( ( key, mcmutil.getGenInfo( key ) ) for key in keys )
+        except Exception as e:
+            log.error("Could not resolve generator info for %s: %s" % ( dataset, e ) )
+            return dataset, dict( ( key, None ) for key in keys )
+    datasets = list( set( datasets ) )
+    if not datasets:
+        return {}
+    pool = ThreadPool( max( 1, min( processes, len( datasets ) ) ) )
+    try:
+        return dict( pool.map( resolve, datasets ) )
+    finally:
+        pool.close()
+        pool.join()
+
 class McMUtilities():
-    def __init__(self):
+    ## The constructor.
+    # @param self: The object pointer.
+    # @param cache: (Optional) McMCache for the json responses
+    def __init__(self, cache = None):
         self.mcm_prefix = "https://cms-pdmv.cern.ch/mcm/public/restapi/requests/produces/"
         self.mcm_json = None # requested json
         self.gen_json = None # gen-sim json
+        self.cache = cache
 
 
     def readJSON(self, json_string):
-        try:
-            return json.load(json_string)
-        except ValueError:
-            log.error("Could not read JSON at request URL.")
-            return None
+        return readMcMJSON(json_string)
+
+
+    # read the json for a dataset, from the cache if one is set
+    def fetchJSON(self, mcm_dataset):
+        if self.cache is not None:
+            return self.cache.fetch(self.mcm_prefix + mcm_dataset, mcm_dataset)
+        return self.readJSON(urllib2.urlopen(self.mcm_prefix + mcm_dataset))
 
 
     def readURL(self, mcm_dataset):
         try:
-            self.mcm_json = self.readJSON(urllib2.urlopen(self.mcm_prefix + mcm_dataset))
+            self.mcm_json = self.fetchJSON(mcm_dataset)
         except urllib2.HTTPError:
             log.error("Could not find dataset " + mcm_dataset)
             self.mcm_json = None
@@ -52,7 +198,7 @@ class McMUtilities():
             # if not, find parent dataset
             input_dataset = tmp_json["results"].get("input_dataset", None)
             if input_dataset is not None:
-                tmp_json = self.readJSON(urllib2.urlopen(self.mcm_prefix + input_dataset))
+                tmp_json = self.fetchJSON(input_dataset)
             else:
                 log.error("No input dataset specified in JSON. Cannot find GEN-SIM sample.")
                 return None
@@ -112,10 +258,13 @@ import das_client
 #
 # This is a helper class for the das_client cli
 #
+# Query responses are cached per query for cacheTTL seconds.
 class dasClientHelper():
     ## The constructor.
     # @param self: The object pointer.
-    def __init__(self):
+    # @param cacheTTL: Time in seconds a cached query response is used, 0 disables the cache
+    # @param pageSize: Number of results per request used by the iter functions
+    def __init__(self, cacheTTL = 600, pageSize = 1000):
         # get all default options for queries
         init_parser = das_client.DASOptionParser()
         # we can not use the class memebr function
@@ -125,6 +274,10 @@ class dasClientHelper():
         # we get all as default
         self.opts.limit = 0
         self.datasetJSON = None
+        self.cacheTTL = cacheTTL
+        self.pageSize = pageSize
+        self._cache = {}
+        self._cacheLock = threading.Lock()
 
     ## Reimplementation of get_data from das_client
     #
@@ -134,37 +287,132 @@ class dasClientHelper():
     # @param dataset: String containing the dataset name
     # @param queryobject: String which specifies the object you want to query (file, block etc.)
     # @param query_aggregation: additional aggregation query parts at the end.
+    # @param idx: Index of the first result [default: opts.idx]
+    # @param limit: Maximum number of results, 0 for all [default: opts.limit]
+    # @param useCache: Use a cached response if available
     # @return json dictionary containing the das query response
-    def get_data(self, dataset, queryobject = None, query_aggregation=None):
+    def get_data(self, dataset, queryobject = None, query_aggregation=None, idx = None, limit = None, useCache = True):
         if queryobject is not None:
             query = queryobject + " "
         else: query = ''
         query += "dataset=%s " % dataset
         if query_aggregation is not None:
             query += " | %s" % query_aggregation
+        if idx is None: idx = self.opts.idx
+        if limit is None: limit = self.opts.limit
+        key = ( query, idx, limit )
+        if useCache and self.cacheTTL > 0:
+            with self._cacheLock:
+                entry = self._cache.get( key )
+            if entry is not None and time.time() - entry[0] < self.cacheTTL:
+                return entry[1]
         jsondict = das_client.get_data( self.opts.host,
                                         query,
-                                        self.opts.idx,
-                                        self.opts.limit,
+                                        idx,
+                                        limit,
                                         self.opts.verbose,
                                         self.opts.threshold,
                                         self.opts.ckey,
                                         self.opts.cert)
+        if self.cacheTTL > 0 and jsondict is not None and jsondict.get( 'status', 'ok' ) == 'ok':
+            with self._cacheLock:
+                self._cache[ key ] = ( time.time(), jsondict )
         return jsondict
+
+    ## Remove cached responses
+    #
+    # @param self: The object pointer.
+    # @param dataset: Only remove responses for this dataset [default: all]
+    def clearCache(self, dataset = None):
+        with self._cacheLock:
+            if dataset is None:
+                self._cache = {}
+            else:
+                for key in [ key for key in self._cache if "dataset=%s " % dataset in key[0] ]:
+                    del self._cache[ key ]
+
     ## Get a dict containing most common dataset infos
     #
     # @param dataset: String containing the dataset name
     # @return A dictionary containing the infos: name, nevents, nfiles, nlumis, nblocks, size (byte)
     def getDatasetSummary( self, dataset):
-        if self.datasetJSON is None:
-            jsondict = self.get_data( dataset )
-            self.datasetJSON = jsondict
-        summary = self.datasetJSON['data'][0]['dataset'][1]
-        for infodict in self.datasetJSON['data'][0]['dataset']:
+        jsondict = self.get_data( dataset )
+        self.datasetJSON = jsondict
+        return self.summaryFromJSON( jsondict )
+
+    ## Extract the dataset summary from a das query response
+    #
+    # The helper state is not touched, so this can be called from several threads.
+    # @param jsondict: The das query response for the dataset
+    # @return A dictionary containing the infos as in getDatasetSummary
+    def summaryFromJSON( self, jsondict ):
+        summary = jsondict['data'][0]['dataset'][1]
+        for infodict in jsondict['data'][0]['dataset']:
             if 'nlumis' in infodict.keys():
                 summary = infodict
             if 'acquisition_era_name' in infodict.keys():
                 extrainfos = infodict
+        summary = dict( summary )
         summary['acquisition_era_name'] = extrainfos['acquisition_era_name']
         summary['datatype'] = extrainfos['datatype']
         return summary
+
+    ## Get the summaries of many datasets concurrently
+    #
+    # @param datasets: List of dataset names
+    # @param processes: Number of simultaneous queries
+    # @return A dictionary with the dataset as key and the summary as value,
+    # None for datasets which could not be queried
+    def getDatasetSummaries( self, datasets, processes = 8 ):
+        # the threads only return their results, datasetJSON is not set
+        def summarize( dataset ):
+            try:
+                return dataset, self.summaryFromJSON( self.get_data( dataset ) )
+            except Exception as e:
+                log.error( "Could not get summary for %s: %s" % ( dataset, str( e ) ) )
+                return dataset, None
+        datasets = list( set( datasets ) )
+        if not datasets:
+            return {}
+        pool = ThreadPool( max( 1, min( processes, len( datasets ) ) ) )
+        try:
+            return dict( pool.map( summarize, datasets ) )
+        finally:
+            pool.close()
+            pool.join()
+
+    ## Iterate over the results of a query page by page
+    #
+    # Pages are not cached, so large results are never held in memory at once.
+    # @param dataset: String containing the dataset name
+    # @param queryobject: String which specifies the object you want to query (file, block etc.)
+    # @param pageSize: Number of results per request [default: self.pageSize]
+    # @return generator of the entries of the queryobject, e.g. the dictionary of a file
+    def iterQuery( self, dataset, queryobject, pageSize = None ):
+        if pageSize is None: pageSize = self.pageSize
+        idx = 0
+        while True:
+            jsondict = self.get_data( dataset, queryobject, idx = idx, limit = pageSize, useCache = False )
+            page = jsondict.get( 'data', [] ) if jsondict is not None else []
+            for row in page:
+                for entry in row.get( queryobject, [] ):
+                    yield entry
+            if len( page ) < pageSize:
+                break
+            idx += pageSize
+
+    ## Iterate over the files of a dataset page by page
+    #
+    # @param dataset: String containing the dataset name
+    # @param pageSize: Number of files per request [default: self.pageSize]
+    # @return generator of file dictionaries (name, size, nevents ...)
+    def iterFiles( self, dataset, pageSize = None ):
+        return self.iterQuery( dataset, 'file', pageSize )
+
+    ## Iterate over the blocks of a dataset page by page
+    #
+    # @param dataset: String containing the dataset name
+    # @param pageSize: Number of blocks per request [default: self.pageSize]
+    # @return generator of block dictionaries
+    def iterBlocks( self, dataset, pageSize = None ):
+        return self.iterQuery( dataset, 'block', pageSize )